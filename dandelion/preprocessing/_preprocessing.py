@@ -15,6 +15,7 @@ from joblib import Parallel, delayed
 from collections import OrderedDict
 from time import sleep
 from ..utilities._utilities import *
+from ..utilities._utilities import _normalise_gene_calls
 from .external._preprocessing import assigngenes_igblast, makedb_igblast, parsedb_heavy, parsedb_light, tigger_genotype, creategermlines
 from plotnine import ggplot, geom_bar, geom_col, ggtitle, scale_fill_manual, coord_flip, options, element_blank, aes, xlab, ylab, facet_wrap, facet_grid, theme_classic, theme, annotate, theme_bw, geom_histogram, geom_vline
 from changeo.Gene import buildGermline
@@ -986,11 +987,13 @@ def reassign_alleles(data, combined_folder, v_germline = None, germline = None,
 
             s2 = set(inf_geno['gene'])
             results = []
+            # the samples share most of their gene calls, so each call is only normalised once
+            memo = {}
             for samp in list(set(heavy['sample_id'])):
                 res_x = heavy[(heavy['sample_id']==samp)]
-                V_ = [re.sub('[*][0-9][0-9]', '', v) for v in res_x['v_call']]
-                V_g = [re.sub('[*][0-9][0-9]', '', v) for v in res_x['v_call_genotyped']]
-                s1 = set(list(','.join([','.join(list(set(v.split(',')))) for v in V_]).split(',')))
+                V_ = _normalise_gene_calls(res_x['v_call'], memo = memo)
+                V_g = _normalise_gene_calls(res_x['v_call_genotyped'], memo = memo)
+                s1 = set(','.join(V_).split(','))
                 setdiff = s1 - s2
                 ambiguous = (["," in i for i in V_].count(True)/len(V_)*100, ["," in i for i in V_g].count(True)/len(V_g)*100)
                 not_in_genotype=([i in setdiff for i in V_].count(True)/len(V_)*100, [i in setdiff for i in V_g].count(True)/len(V_g)*100)
@@ -1219,11 +1222,13 @@ def reassign_alleles_(data, combined_folder, germline = None, org = 'human', fil
 
         s2 = set(inf_geno['gene'])
         results = []
+        # the samples share most of their gene calls, so each call is only normalised once
+        memo = {}
         for samp in list(set(out_h['sample_id'])):
             res_x = out_h[(out_h['sample_id']==samp)]
-            V_ = [re.sub('[*][0-9][0-9]', '', v) for v in res_x['v_call']]
-            V_g = [re.sub('[*][0-9][0-9]', '', v) for v in res_x['v_call_genotyped']]
-            s1 = set(list(','.join([','.join(list(set(v.split(',')))) for v in V_]).split(',')))
+            V_ = _normalise_gene_calls(res_x['v_call'], memo = memo)
+            V_g = _normalise_gene_calls(res_x['v_call_genotyped'], memo = memo)
+            s1 = set(','.join(V_).split(','))
             setdiff = s1 - s2
             ambiguous = (["," in i for i in V_].count(True)/len(V_)*100, ["," in i for i in V_g].count(True)/len(V_g)*100)
             not_in_genotype=([i in setdiff for i in V_].count(True)/len(V_)*100, [i in setdiff for i in V_g].count(True)/len(V_g)*100)
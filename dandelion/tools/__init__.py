@@ -6,4 +6,5 @@
 
 from ._tools import find_clones, transfer, define_clones, clone_size, clone_overlap
 from ._network import extract_edge_weights, clone_degree, clone_centrality, generate_network
-from ._diversity import clone_diversity, clone_rarefaction
\ No newline at end of file
+from ._diversity import clone_diversity, clone_rarefaction
+from ._index import CloneIndex, build_clone_index, read_clone_index
\ No newline at end of file
@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2021-02-05 10:12:41
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2021-02-05 10:12:41
+
+import numpy as np
+from itertools import repeat
+from polyleven import levenshtein
+from joblib import Parallel, delayed
+
+# upper bound (in bytes) for the temporary comparison array created per chunk
+CHUNK_MEMORY = 64 * 1024**2
+# bytes per compared pair on top of the boolean comparison of their sequences
+PAIR_OVERHEAD = 10
+# partitions with at least this many unique sequences are searched with a pigeonhole index rather than all-vs-all
+PIGEONHOLE_MIN_SIZE = 1000
+# number of sequence pairs handed to the edit distance kernel at a time
+LEVENSHTEIN_BATCH = 100000
+
+
+def _encode_junctions(seqs, width = None):
+    """
+    Encodes a list of sequences into a fixed-width uint8 matrix.
+
+    Parameters
+    ----------
+    seqs : list
+        list of sequences (str).
+    width : int, optional
+        number of columns of the encoded matrix. None defaults to the length of the longest sequence. Shorter sequences are padded with 0.
+
+    Returns
+    -------
+    numpy ndarray of shape (len(seqs), width) and dtype uint8.
+    """
+    seqs = [str(s) for s in seqs]
+    lengths = [len(s) for s in seqs]
+    if width is None:
+        width = max(lengths) if len(lengths) > 0 else 0
+    if len(set(lengths)) == 1 and lengths[0] == width:
+        # fast path, all sequences share the same length
+        return np.frombuffer(''.join(seqs).encode('latin-1', 'replace'), dtype = np.uint8).reshape(len(seqs), width).copy()
+    encoded = np.zeros((len(seqs), width), dtype = np.uint8)
+    # encode each length in one go
+    by_length = {}
+    for i, l in enumerate(lengths):
+        by_length.setdefault(min(l, width), []).append(i)
+    for l, idx in by_length.items():
+        if l == 0:
+            continue
+        block = ''.join([seqs[i][:l] for i in idx]).encode('latin-1', 'replace')
+        encoded[idx, :l] = np.frombuffer(block, dtype = np.uint8).reshape(len(idx), l)
+    return encoded
+
+
+def _parse_memory(max_memory):
+    """
+    Converts a memory budget such as '4GB' or '500MB' into bytes. None defaults to `CHUNK_MEMORY`.
+    """
+    if max_memory is None:
+        return CHUNK_MEMORY
+    if isinstance(max_memory, (int, float, np.integer)):
+        return int(max_memory)
+    units = {'B':1, 'K':1024, 'KB':1024, 'M':1024**2, 'MB':1024**2, 'G':1024**3, 'GB':1024**3, 'T':1024**4, 'TB':1024**4}
+    value = str(max_memory).strip().upper()
+    number = value.rstrip('BKMGT').strip()
+    unit = value[len(value.rstrip('BKMGT')):] or 'B'
+    try:
+        return int(float(number) * units[unit])
+    except (KeyError, ValueError):
+        raise ValueError("Unable to interpret max_memory = {}. Please provide the number of bytes or a string such as '4GB'.".format(max_memory))
+
+
+def _chunk_rows(n_cols, pair_bytes, chunk_size = None, max_memory = None):
+    """
+    Number of rows to compare at once so that the temporary arrays, `pair_bytes` bytes per compared pair, stay within `max_memory` bytes (default `CHUNK_MEMORY`).
+    """
+    if chunk_size is not None:
+        return max(int(chunk_size), 1)
+    budget = CHUNK_MEMORY if max_memory is None else max_memory
+    return max(int(budget // max(n_cols * max(pair_bytes, 1), 1)), 1)
+
+
+def _mismatches(X, Y, out):
+    """
+    Counts the mismatches between every row of X and every row of Y into the uint16 array `out`, without an int64 intermediate.
+    """
+    return np.sum(X[:, np.newaxis, :] != Y[np.newaxis, :, :], axis = 2, dtype = np.uint16, out = out)
+
+
+def _nearest_rows(X, Y, chunk_size = None, max_memory = None):
+    """
+    Finds the closest row of Y for each row of X by hamming distance.
+
+    Parameters
+    ----------
+    X : ndarray
+        encoded sequences from `_encode_junctions`.
+    Y : ndarray
+        second set of encoded sequences with the same width.
+    chunk_size : int, optional
+        number of rows of X compared per broadcast. None sizes the chunks to `max_memory`.
+    max_memory : int, optional
+        memory budget in bytes for the temporary comparison arrays. None defaults to `CHUNK_MEMORY`.
+
+    Returns
+    -------
+    tuple of (index of the closest row of Y, hamming distance) arrays, one per row of X. The full distance matrix is never held in memory.
+    """
+    if X.shape[1] != Y.shape[1]:
+        raise ValueError('Encoded sequences must have the same width.')
+    n, m = X.shape[0], Y.shape[0]
+    nearest = np.zeros(n, dtype = np.int64)
+    dist = np.zeros(n, dtype = np.uint16)
+    # the boolean comparison plus the uint16 counts per pair, with some room for the buffers of the reduction
+    step = _chunk_rows(m, X.shape[1] + PAIR_OVERHEAD, chunk_size, max_memory)
+    buf = np.empty((min(step, n), m), dtype = np.uint16)
+    for i in range(0, n, step):
+        block = _mismatches(X[i:i+step], Y, buf[:min(step, n - i)])
+        block.argmin(axis = 1, out = nearest[i:i+step])
+        block.min(axis = 1, out = dist[i:i+step])
+    return nearest, dist
+
+
+def _blocked_pairs(X, max_distance, chunk_size = None, max_memory = None):
+    """
+    Sub-threshold pairs from an all-vs-all comparison.
+
+    The lower triangle is compared in blocks of rows sized to `max_memory` and only the pairs within `max_distance` are kept,
+    so the full distance matrix is never held in memory.
+    """
+    n, width = X.shape
+    # the boolean comparison, the uint16 counts and the boolean threshold mask per pair, with some room for the buffers of the reduction
+    step = _chunk_rows(n, width + PAIR_OVERHEAD, chunk_size, max_memory)
+    buf = np.empty((min(step, n), n), dtype = np.uint16)
+    mask = np.empty((min(step, n), n), dtype = bool)
+    source, target, dist = [], [], []
+    for i in range(0, n, step):
+        rows, cols = min(step, n - i), min(i + step, n)
+        block = _mismatches(X[i:i+rows], X[:cols], buf[:rows, :cols])
+        keep = np.less_equal(block, max_distance, out = mask[:rows, :cols])
+        # keep the pairs below the diagonal, i.e. column < row
+        for k in range(rows):
+            keep[k, i+k:] = False
+        r, c = np.nonzero(keep)
+        # empty blocks are not collected, as many small blocks would add up under a tight budget
+        if len(r) > 0:
+            source.append(r + i)
+            target.append(c)
+            dist.append(block[r, c])
+    if len(source) == 0:
+        empty = np.zeros(0, dtype = np.int64)
+        return empty, empty, np.zeros(0, dtype = np.uint16)
+    return np.concatenate(source), np.concatenate(target), np.concatenate(dist)
+
+
+def _segment_buckets(X, start, stop):
+    """
+    Groups rows that are identical within columns [start, stop). Returns the bucket of each row, the row indices sorted by bucket and the bucket sizes.
+    """
+    seg = np.ascontiguousarray(X[:, start:stop]).view(np.dtype((np.void, stop - start))).ravel()
+    _, inverse = np.unique(seg, return_inverse = True)
+    inverse = inverse.ravel()
+    return inverse, np.argsort(inverse, kind = 'stable'), np.bincount(inverse)
+
+
+def _pigeonhole_pairs(X, max_distance, chunk_size = None, max_memory = None):
+    """
+    Sub-threshold pairs from a pigeonhole index.
+
+    Each sequence is split into `max_distance + 1` segments. Two sequences that differ at no more than `max_distance` positions must agree on at least one segment,
+    so only pairs sharing a segment bucket are compared. Returns None if the buckets are too crowded for the index to save any work.
+
+    The candidate pairs are numbered bucket by bucket and generated and verified in batches sized to `max_memory`, so they are never all held in memory.
+    A pair is only kept from the first segment its two sequences agree on, so that pairs sharing several segments are reported once.
+    """
+    n, width = X.shape
+    bounds = np.linspace(0, width, max_distance + 2).astype(int)
+    buckets = [_segment_buckets(X, a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+    n_candidates = sum([int((sizes * (sizes - 1) // 2).sum()) for _, _, sizes in buckets])
+    if n_candidates > n * (n - 1) // 8:
+        return None
+    # every bucket with more than one member, across all segments, as (segment, first position in the sorted rows, size)
+    segment, first, size = [], [], []
+    for i, (_, order, sizes) in enumerate(buckets):
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        keep = sizes > 1
+        segment.append(np.full(keep.sum(), i))
+        first.append(offsets[keep])
+        size.append(sizes[keep])
+    segment, first, size = np.concatenate(segment), np.concatenate(first).astype(np.int64), np.concatenate(size).astype(np.int64)
+    ends = np.cumsum(size * (size - 1) // 2)
+    inverse = np.stack([inv for inv, _, _ in buckets])
+    order = np.stack([o for _, o, _ in buckets])
+    # about ten int64 arrays and two encoded rows per candidate
+    step = _chunk_rows(1, 80 + 2 * width, chunk_size, max_memory)
+    source, target, dist = [], [], []
+    for lo in range(0, n_candidates, step):
+        k = np.arange(lo, min(lo + step, n_candidates), dtype = np.int64)
+        bucket = np.searchsorted(ends, k, side = 'right')
+        k = k - (ends[bucket] - size[bucket] * (size[bucket] - 1) // 2)
+        # k indexes the pairs (r, c) with c < r of the bucket, in row order
+        r = np.floor((1 + np.sqrt(1 + 8 * k.astype(float))) / 2).astype(np.int64)
+        r -= r * (r - 1) // 2 > k
+        r += (r + 1) * r // 2 <= k
+        c = k - r * (r - 1) // 2
+        seg = segment[bucket]
+        a, b = order[seg, first[bucket] + r], order[seg, first[bucket] + c]
+        # drop the pairs that already agree on an earlier segment
+        keep = np.ones(len(k), dtype = bool)
+        for e in range(inverse.shape[0] - 1):
+            keep &= ~((seg > e) & (inverse[e, a] == inverse[e, b]))
+        a, b = a[keep], b[keep]
+        d = np.count_nonzero(X[a] != X[b], axis = 1)
+        keep = d <= max_distance
+        source.append(np.maximum(a, b)[keep])
+        target.append(np.minimum(a, b)[keep])
+        dist.append(d[keep].astype(np.uint16))
+    if len(source) == 0:
+        empty = np.zeros(0, dtype = np.int64)
+        return empty, empty, np.zeros(0, dtype = np.uint16)
+    return np.concatenate(source), np.concatenate(target), np.concatenate(dist)
+
+
+def _neighbour_pairs(X, max_distance, chunk_size = None, max_memory = None):
+    """
+    Finds all pairs of encoded sequences within a hamming distance.
+
+    Parameters
+    ----------
+    X : ndarray
+        encoded sequences from `_encode_junctions`.
+    max_distance : int
+        maximum number of mismatches.
+    chunk_size : int, optional
+        number of rows compared per broadcast. None sizes the chunks to `max_memory`.
+    max_memory : int, optional
+        memory budget in bytes for the temporary comparison arrays. None defaults to `CHUNK_MEMORY`.
+
+    Returns
+    -------
+    sparse edge list in COO form: a tuple of (source, target, distance) arrays with source > target for every pair within `max_distance`.
+    """
+    n, width = X.shape
+    if n >= PIGEONHOLE_MIN_SIZE and 0 <= max_distance < width:
+        pairs = _pigeonhole_pairs(X, max_distance, chunk_size, max_memory)
+        if pairs is not None:
+            return pairs
+    return _blocked_pairs(X, max_distance, chunk_size, max_memory)
+
+
+def _collapse_junctions(seqs):
+    """
+    Collapses exact duplicate sequences.
+
+    Parameters
+    ----------
+    seqs : list
+        list of sequences (str).
+
+    Returns
+    -------
+    tuple of sorted unique sequences, the index of each input sequence in the unique sequences, and the multiplicity of each unique sequence.
+    """
+    unique, inverse, counts = np.unique(np.array([str(s) for s in seqs], dtype = str), return_inverse = True, return_counts = True)
+    return unique, inverse.ravel(), counts
+
+
+def _expand_pairs(inverse, source, target, dist):
+    """
+    Expands pairs of unique sequences to pairs of the sequences they were collapsed from.
+
+    Parameters
+    ----------
+    inverse : ndarray
+        index of each sequence in the unique sequences, as returned by `_collapse_junctions`.
+    source, target, dist : ndarray
+        pairs of unique sequences and their distances.
+
+    Returns
+    -------
+    tuple of source, target and distance arrays over the input sequences. Duplicates of the same unique sequence are paired with a distance of 0.
+    """
+    inverse = np.asarray(inverse)
+    order = np.argsort(inverse, kind = 'stable')
+    counts = np.bincount(inverse)
+    starts = np.cumsum(counts) - counts
+    # duplicates are pairs of a unique sequence with itself, only the upper triangle is kept
+    dup = np.flatnonzero(counts > 1)
+    source = np.concatenate([np.asarray(source, dtype = np.int64), dup])
+    target = np.concatenate([np.asarray(target, dtype = np.int64), dup])
+    dist = np.concatenate([np.asarray(dist), np.zeros(len(dup), dtype = np.asarray(dist).dtype)])
+    # every pair of unique sequences expands to the product of their members
+    reps = counts[source] * counts[target]
+    k = np.repeat(np.arange(len(source)), reps)
+    offset = np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps)
+    a, b = np.divmod(offset, counts[target][k])
+    keep = (source[k] != target[k]) | (a < b)
+    k, a, b = k[keep], a[keep], b[keep]
+    return order[starts[source[k]] + a], order[starts[target[k]] + b], dist[k]
+
+
+def _union_find(n, source, target, dist = None, cuts = None):
+    """
+    Connected components of a sparse edge list with a disjoint-set forest.
+
+    Parameters
+    ----------
+    n : int
+        number of nodes.
+    source, target : ndarray
+        end points of the edges.
+    dist : ndarray, optional
+        edge distances. Only required with `cuts`.
+    cuts : list, optional
+        distance thresholds. If provided, the edges are linked in order of distance and the components are recorded once all edges within each threshold are linked,
+        i.e. the single linkage hierarchy is cut at every threshold.
+
+    Returns
+    -------
+    numpy ndarray with the smallest node index of each node's component, or one row per threshold if `cuts` is provided.
+    """
+    parent = list(range(n))
+
+    def find(x):
+        # path halving, every other node on the way up points to its grandparent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(a, b):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            # the smaller index becomes the root so that the labels are deterministic
+            if ra < rb:
+                parent[rb] = ra
+            else:
+                parent[ra] = rb
+
+    source, target = np.asarray(source).tolist(), np.asarray(target).tolist()
+    if cuts is None:
+        for a, b in zip(source, target):
+            union(a, b)
+        return np.array([find(x) for x in range(n)], dtype = np.int64)
+
+    order = np.argsort(dist, kind = 'stable')
+    dist = np.asarray(dist)[order]
+    labels = np.zeros((len(cuts), n), dtype = np.int64)
+    e = 0
+    for i in np.argsort(cuts, kind = 'stable'):
+        while e < len(order) and dist[e] <= cuts[i]:
+            union(source[order[e]], target[order[e]])
+            e += 1
+        labels[i] = [find(x) for x in range(n)]
+    return labels
+
+
+def _banded_edit_distance(A, B, max_distance):
+    """
+    Levenshtein distances between paired rows of encoded sequences, restricted to a band around the diagonal.
+
+    Only cells within `max_distance` of the diagonal can be on an alignment path with at most `max_distance` edits, so the dynamic programming is done on a band of
+    2 * `max_distance` + 1 cells per row for all pairs at once. Pairs whose band minimum exceeds `max_distance` are dropped as soon as that happens.
+
+    Parameters
+    ----------
+    A : ndarray
+        encoded sequences of length m.
+    B : ndarray
+        encoded sequences of length n, paired with the rows of A, with n >= m.
+    max_distance : int
+        maximum number of edits.
+
+    Returns
+    -------
+    numpy ndarray of distances, one per pair. Pairs further apart than `max_distance` are set to `max_distance` + 1.
+    """
+    P, m = A.shape
+    n = B.shape[1]
+    t = int(max_distance)
+    far = np.full(P, t + 1, dtype = np.uint16)
+    if n - m > t or P == 0:
+        return far
+    inf = np.int32(t + 1)
+    band = 2 * t + 1
+    offsets = np.arange(band)
+    # row 0, cell j = offset - t is j insertions away
+    prev = np.where(offsets >= t, offsets - t, inf).astype(np.int32)
+    prev = np.minimum(np.broadcast_to(prev, (P, band)), inf).copy()
+    alive = np.arange(P)
+    for i in range(1, m + 1):
+        cur = np.full((len(alive), band), inf, dtype = np.int32)
+        for o in range(band):
+            j = i + o - t
+            if j < 0 or j > n:
+                continue
+            if j == 0:
+                cur[:, o] = min(i, inf)
+                continue
+            # substitution or match
+            best = prev[:, o] + (A[alive, i - 1] != B[alive, j - 1])
+            # deletion
+            if o + 1 < band:
+                best = np.minimum(best, prev[:, o + 1] + 1)
+            # insertion
+            if o > 0:
+                best = np.minimum(best, cur[:, o - 1] + 1)
+            cur[:, o] = np.minimum(best, inf)
+        # early termination, pairs that can no longer come in within the band are dropped
+        keep = cur.min(axis = 1) <= t
+        if not keep.all():
+            cur, alive = cur[keep], alive[keep]
+            if len(alive) == 0:
+                return far
+        prev = cur
+    far[alive] = prev[:, n - m + t]
+    return far
+
+
+def _indel_pairs(X, Y, max_distance, max_memory = None):
+    """
+    Pairs of encoded sequences of two different lengths within `max_distance` edits.
+
+    Parameters
+    ----------
+    X : ndarray
+        encoded sequences of the shorter length.
+    Y : ndarray
+        encoded sequences of the longer length.
+    max_distance : int
+        maximum number of edits.
+    max_memory : int, optional
+        memory budget in bytes for each block of pairs. None defaults to `CHUNK_MEMORY`.
+
+    Returns
+    -------
+    tuple of (row in X, row in Y, distance) arrays.
+    """
+    n1, n2 = X.shape[0], Y.shape[0]
+    budget = CHUNK_MEMORY if max_memory is None else max_memory
+    # bytes per pair: both sequences plus two rows of the band
+    step = max(int(budget // (X.shape[1] + Y.shape[1] + 16 * (2 * max_distance + 1))), 1)
+    source, target, dist = [], [], []
+    for start in range(0, n1 * n2, step):
+        k = np.arange(start, min(start + step, n1 * n2))
+        a, b = k // n2, k % n2
+        d = _banded_edit_distance(X[a], Y[b], max_distance)
+        keep = d <= max_distance
+        source.append(a[keep])
+        target.append(b[keep])
+        dist.append(d[keep])
+    if len(source) == 0:
+        empty = np.zeros(0, dtype = np.int64)
+        return empty, empty, np.zeros(0, dtype = np.uint16)
+    return np.concatenate(source), np.concatenate(target), np.concatenate(dist)
+
+
+def _levenshtein_batch(A, B, max_distance = None):
+    """
+    Levenshtein distances between two equally long lists of sequences, pair by pair.
+    With `max_distance`, each comparison stops as soon as the cap is exceeded and returns `max_distance` + 1.
+    """
+    if max_distance is None:
+        return np.fromiter(map(levenshtein, A, B), dtype = np.int64, count = len(A))
+    return np.fromiter(map(levenshtein, A, B, repeat(int(max_distance))), dtype = np.int64, count = len(A))
+
+
+def _levenshtein_pairs(seqs, source, target, max_distance = None, ncpu = None, backend = None, batch_size = None):
+    """
+    Levenshtein distances for a list of index pairs into a list of sequences.
+
+    Repeated sequences are only compared once: the sequences are encoded as indices into their unique values and
+    each distinct pair of unique sequences is computed a single time, in batches that can be spread over a pool of workers.
+
+    Parameters
+    ----------
+    seqs : list
+        list of sequences (str).
+    source, target : ndarray
+        indices into `seqs` of the pairs to compare.
+    max_distance : int, optional
+        cap on the distances. Pairs further apart are reported as `max_distance` + 1, without computing their exact distance. None defaults to exact distances.
+    ncpu : int, optional
+        number of workers. None defaults to 1 (no parallelization). -1 uses all available cpus.
+    backend : str, optional
+        `joblib` backend. None defaults to 'loky'.
+    batch_size : int, optional
+        number of pairs per batch. None defaults to `LEVENSHTEIN_BATCH`.
+
+    Returns
+    -------
+    numpy ndarray of distances, one per pair.
+    """
+    unique, codes = np.unique(np.array([str(x) for x in seqs], dtype = object), return_inverse = True)
+    codes = codes.ravel()
+    a, b = codes[np.asarray(source, dtype = np.int64)], codes[np.asarray(target, dtype = np.int64)]
+    # distinct pairs of unique sequences, identical sequences need no comparison
+    keys, inverse = np.unique(np.minimum(a, b) * len(unique) + np.maximum(a, b), return_inverse = True)
+    ua, ub = np.divmod(keys, max(len(unique), 1))
+    dist = np.zeros(len(keys), dtype = np.int64)
+    todo = ua != ub
+    if max_distance is not None:
+        # the length difference is a lower bound on the distance
+        lengths = np.array([len(x) for x in unique], dtype = np.int64)
+        far = np.abs(lengths[ua] - lengths[ub]) > max_distance
+        dist[far] = int(max_distance) + 1
+        todo &= ~far
+    todo = np.flatnonzero(todo)
+    batch_size = LEVENSHTEIN_BATCH if batch_size is None else int(batch_size)
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    if ncpu is None or int(ncpu) == 1 or len(batches) < 2:
+        res = [_levenshtein_batch(unique[ua[k]], unique[ub[k]], max_distance) for k in batches]
+    else:
+        if backend is None:
+            backend = 'loky'
+        res = Parallel(n_jobs = int(ncpu), backend = backend)(delayed(_levenshtein_batch)(unique[ua[k]], unique[ub[k]], max_distance) for k in batches)
+    for k, d in zip(batches, res):
+        dist[k] = d
+    return dist[inverse.ravel()]
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2021-02-05 15:40:12
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2021-02-05 15:40:12
+
+import os
+import json
+import pandas as pd
+import numpy as np
+from ..utilities._utilities import *
+from ._distance import _encode_junctions
+from ._tools import _gene_calls, _junction_lengths, _canonical_call
+try:
+    from scanpy import logging as logg
+except ImportError:
+    pass
+
+
+class CloneIndex:
+    """
+    Clone index class object.
+
+    Stores, per V/J/junction length partition, the encoded junctions of clonally assigned heavy chain contigs together with their clone ids and member counts.
+    Indices written to disk are memory-mapped when read back with `read_clone_index`. `find_clones` extends the index with the contigs it assigns, so that it
+    only needs to be written back rather than rebuilt.
+
+    """
+    def __init__(self, partitions, junctions, clones, counts, params = None):
+        self.partitions = partitions
+        self.junctions = junctions
+        self.clones = clones
+        self.counts = counts
+        self.params = {} if params is None else params
+        self._lookup = {(v, j, int(l)):(start, stop) for v, j, l, start, stop in zip(partitions['v_call'], partitions['j_call'], partitions['junction_length'], partitions['start'], partitions['stop'])}
+
+    def __repr__(self) -> str:
+        return "CloneIndex object with n_partitions = {}, n_junctions = {} and n_contigs = {}".format(self.partitions.shape[0], self.junctions.shape[0], self.n_contigs)
+
+    @property
+    def n_contigs(self):
+        """
+        Number of contigs in the index.
+        """
+        return int(np.asarray(self.counts).sum())
+
+    def __contains__(self, key):
+        v, j, l = key
+        return (_canonical_call(v), _canonical_call(j), int(l)) in self._lookup
+
+    def lookup(self, v, j, length):
+        """
+        Retrieves the members of a V/J/length partition.
+
+        Parameters
+        ----------
+        v : str
+            V gene call of the partition.
+        j : str
+            J gene call of the partition.
+        length : int
+            junction length of the partition.
+
+        Returns
+        -------
+        tuple of encoded junctions, clone ids and member counts. Empty arrays are returned if the partition is not in the index.
+        """
+        key = (_canonical_call(v), _canonical_call(j), int(length))
+        if key not in self._lookup:
+            return(self.junctions[0:0], self.clones[0:0], self.counts[0:0])
+        start, stop = self._lookup[key]
+        return(self.junctions[start:stop], self.clones[start:stop], self.counts[start:stop])
+
+    def validate(self, data, clone_key = None):
+        """
+        Checks that the index holds exactly the clonally assigned contigs of a contig table.
+
+        Parameters
+        ----------
+        data : DataFrame
+            contig table of the clonally assigned heavy chain contigs.
+        clone_key : str, optional
+            column name for clones. None defaults to the `clone_key` the index was built with.
+
+        Raises
+        ------
+        ValueError
+            if the contigs or their clone ids differ from the ones in the index.
+        """
+        clonekey = self.params.get('clone_key', 'clone_id') if clone_key is None else clone_key
+        n, checksum = data.shape[0], _contig_checksum(data['sequence_id'], data[clonekey])
+        if (n != self.n_contigs) or (self.params.get('checksum', checksum) != checksum):
+            raise ValueError('clone_index does not match the data: it holds {} contigs while the data has {} clonally assigned contigs, or their clone ids differ. Please rebuild it with build_clone_index.'.format(self.n_contigs, n))
+
+    def update(self, data, clone_key = None, memo = None):
+        """
+        Adds newly assigned contigs to the index.
+
+        Parameters
+        ----------
+        data : DataFrame
+            contig table of heavy chain contigs that were assigned to clones since the index was built or last updated.
+        clone_key : str, optional
+            column name for clones. None defaults to the `clone_key` the index was built with.
+        memo : dict, optional
+            memo of normalised gene calls, e.g. `Dandelion._gene_call_memo`.
+        """
+        params = dict(self.params)
+        new, checksum = _index_table(data, dict(params, clone_key = params.get('clone_key', 'clone_id') if clone_key is None else clone_key), memo)
+        if new.shape[0] == 0:
+            return
+        sizes = np.asarray(self.partitions['stop'] - self.partitions['start'])
+        old = pd.DataFrame({'v_call':np.repeat(self.partitions['v_call'].values, sizes), 'j_call':np.repeat(self.partitions['j_call'].values, sizes), 'junction_length':np.repeat(self.partitions['junction_length'].values, sizes),
+            'junction':[bytes(x).rstrip(b'\x00').decode('latin-1') for x in np.asarray(self.junctions)], 'clone':np.asarray(self.clones), 'count':np.asarray(self.counts)})
+        # junctions already in the index keep their clone
+        tab = pd.concat([old, new]).groupby(['v_call', 'j_call', 'junction_length', 'junction'], sort = True).agg(clone = ('clone', 'first'), count = ('count', 'sum')).reset_index()
+        params['checksum'] = (self.params.get('checksum', 0) + checksum) % 2**64
+        self.__init__(*_index_arrays(tab), params = params)
+
+    def write(self, filename = 'dandelion_data.cloneidx'):
+        """
+        Writes a `CloneIndex` to disk as a folder of numpy arrays.
+
+        Parameters
+        ----------
+        filename
+            path to the clone index folder. It can be saved next to the Dandelion `.h5` or `.pkl` file.
+        """
+        if not os.path.exists(filename):
+            os.makedirs(filename)
+        np.save(os.path.join(filename, 'junctions.npy'), np.asarray(self.junctions))
+        np.save(os.path.join(filename, 'clones.npy'), np.asarray(self.clones))
+        np.save(os.path.join(filename, 'counts.npy'), np.asarray(self.counts))
+        self.partitions.to_csv(os.path.join(filename, 'partitions.tsv'), sep = '\t', index = False)
+        with open(os.path.join(filename, 'params.json'), 'w') as f:
+            json.dump(self.params, f)
+
+
+def build_clone_index(self, clone_key = None, key = None, locus = None, by_alleles = False, recalculate_length = True):
+    """
+    Builds a persistent clone index from clonally assigned heavy chain contigs.
+
+    Parameters
+    ----------
+    self : Dandelion, DataFrame, str
+        `Dandelion` object, pandas `DataFrame` in changeo/airr format, or file path to changeo/airr file after clones have been determined.
+    clone_key : str, optional
+        column name for clones. None defaults to 'clone_id'.
+    key : str, optional
+        column name used for clone clustering. None defaults to 'junction_aa'.
+    locus : str, optional
+        placeholder to allow for future tcr analysis mode. None defaults to 'bcr'.
+    by_alleles : bool
+        Whether or not clones were determined without collapsing alleles to genes. Default is False.
+    recalculate_length : bool
+        Whether or not to re-calculate junction length, rather than rely on parsed assignment. Default is True
+
+    Returns
+    -------
+    `CloneIndex` object.
+    """
+    start = logg.info('Building clone index')
+    if self.__class__ == Dandelion:
+        dat = load_data(self.data)
+        memo = getattr(self, '_gene_call_memo', None)
+    else:
+        dat = load_data(self)
+        memo = None
+
+    locus_dict = {'bcr':'IGH', 'BCR':'IGH', 'ig':'IGH'}
+    locus_ = 'IGH' if locus is None else locus_dict[locus]
+    key_ = 'junction_aa' if key is None else key
+    clonekey = 'clone_id' if clone_key is None else clone_key
+    if clonekey not in dat.columns:
+        raise ValueError('Data does not contain clone information. Please run find_clones.')
+
+    params = {'key':key_, 'clone_key':clonekey, 'locus':locus_, 'by_alleles':by_alleles, 'recalculate_length':recalculate_length}
+    tab, params['checksum'] = _index_table(dat, params, memo)
+    out = CloneIndex(*_index_arrays(tab), params = params)
+    logg.info(' finished', time=start, deep=('Returned CloneIndex object\n'))
+    return(out)
+
+
+def _index_table(dat, params, memo = None):
+    """
+    Collapses the clonally assigned heavy chain contigs of a contig table to one row per V/J/length/junction, with the clone and number of contigs.
+    Returns the table and the checksum of the contigs.
+    """
+    clonekey, key_ = params['clone_key'], params['key']
+    dat_heavy = dat[dat['locus'] == params['locus']]
+    dat_heavy = dat_heavy[~(pd.isnull(dat_heavy[clonekey]) | dat_heavy[clonekey].isin(['', 'nan', 'None', 'unassigned']))]
+    V, J = _gene_calls(dat_heavy, params['by_alleles'], memo)
+    L = _junction_lengths(dat_heavy, key_, params.get('recalculate_length', True), params['locus'])
+    tab = pd.DataFrame({'v_call':[_canonical_call(v) for v in V], 'j_call':[_canonical_call(j) for j in J], 'junction_length':L, 'junction':[str(x) for x in dat_heavy[key_]], 'clone':[str(x) for x in dat_heavy[clonekey]]})
+    tab = tab.groupby(['v_call', 'j_call', 'junction_length', 'junction'], sort = True).agg(clone = ('clone', 'first'), count = ('clone', 'size')).reset_index()
+    return(tab, _contig_checksum(dat_heavy['sequence_id'], dat_heavy[clonekey]))
+
+
+def _index_arrays(tab):
+    """
+    Partition table, encoded junctions, clones and counts of a `CloneIndex` from a table sorted by V/J/length/junction.
+    """
+    partitions = tab.groupby(['v_call', 'j_call', 'junction_length'], sort = False).size().reset_index(name = 'n')
+    partitions['stop'] = partitions['n'].cumsum()
+    partitions['start'] = partitions['stop'] - partitions['n']
+    partitions = partitions[['v_call', 'j_call', 'junction_length', 'start', 'stop']]
+    return(partitions, _encode_junctions(tab['junction']), np.array(tab['clone'], dtype = str), np.array(tab['count'], dtype = np.int32))
+
+
+def _contig_checksum(sequence_ids, clones):
+    """
+    Order independent checksum of the (sequence_id, clone id) pairs of a contig table. Checksums of disjoint tables add up (modulo 2**64).
+    """
+    if len(sequence_ids) == 0:
+        return(0)
+    h = pd.util.hash_pandas_object(pd.DataFrame({'sequence_id':[str(x) for x in sequence_ids], 'clone':[str(x) for x in clones]}), index = False).values
+    return(int(h.sum(dtype = np.uint64)))
+
+
+def read_clone_index(filename = 'dandelion_data.cloneidx'):
+    """
+    Reads in and returns a `CloneIndex` written with `CloneIndex.write`. The arrays are memory-mapped rather than loaded into memory.
+
+    Parameters
+    ----------
+    filename
+        path to the clone index folder.
+
+    Returns
+    -------
+    `CloneIndex` object.
+    """
+    if not os.path.isdir(filename):
+        raise OSError('{} is not a clone index folder.'.format(filename))
+    junctions = np.load(os.path.join(filename, 'junctions.npy'), mmap_mode = 'r')
+    clones = np.load(os.path.join(filename, 'clones.npy'), mmap_mode = 'r')
+    counts = np.load(os.path.join(filename, 'counts.npy'), mmap_mode = 'r')
+    partitions = pd.read_csv(os.path.join(filename, 'partitions.tsv'), sep = '\t', dtype = {'v_call':str, 'j_call':str})
+    with open(os.path.join(filename, 'params.json')) as f:
+        params = json.load(f)
+    return(CloneIndex(partitions, junctions, clones, counts, params = params))
@@ -7,24 +7,28 @@
 import pandas as pd
 import numpy as np
 import networkx as nx
-from polyleven import levenshtein
 from ..utilities._utilities import *
+from ._distance import _levenshtein_pairs
 from networkx.utils import random_state
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, coo_matrix, triu
 from scipy.sparse.csgraph import minimum_spanning_tree
-from scipy.spatial.distance import pdist, squareform
-from itertools import combinations
 from tqdm import tqdm
+from joblib import Parallel, delayed, effective_n_jobs
 from time import sleep
 try:
     from scanpy import logging as logg
 except ImportError:
     pass
 
-def generate_network(self, key = None, clone_key = None, scale=False, min_size=2, weights = None, downsample = None, verbose = True, **kwargs):
+# graphs with at least this many nodes are laid out with the grid approximated force layout
+APPROXIMATE_LAYOUT_MIN_SIZE = 500
+# average number of nodes per cell of the finest grid of the approximated force layout
+LAYOUT_LEAF_SIZE = 4
+
+def generate_network(self, key = None, clone_key = None, scale=False, min_size=2, weights = None, downsample = None, verbose = True, distance_key = None, max_distance = None, ncpu = None, backend = None, **kwargs):
     """
     Generates a Levenshtein distance network based on full length VDJ sequence alignments for heavy and light chain(s).
-    The distance matrices are then combined into a singular matrix.
+    The distance matrices are then combined into a singular matrix. Distances are only calculated between cells of the same clone, including '|' joined overlapping clones, and are stored as sparse matrices.
 
     Parameters
     ----------
@@ -44,8 +48,16 @@ def generate_network(self, key = None, clone_key = None, scale=False, min_size=2
         whether or not to downsample the number of cells prior to construction of network. If provided, cells will be randomly sampled to the integer provided. A new Dandelion class will be returned.
     verbose : bool
         whether or not to print the progress bars.
+    distance_key : str, optional
+        name of a sparse distance matrix in `.distance` to build the network from instead of calculating distances, e.g. 'junction' after `tl.find_clones` with `store_distance = True`. Only the stored pairs are considered, and `key`, `scale` and `weights` are ignored. None defaults to calculating the distances.
+    max_distance : int, optional
+        cap on the Levenshtein distance of each chain. Comparisons stop as soon as the cap is exceeded and such pairs are stored as `max_distance` + 1 ('far') instead of their exact distance, which is much faster for full length sequences. None defaults to exact distances.
+    ncpu : int, optional
+        number of workers used to calculate the distances and to build the networks of the clones. None defaults to 1 (no parallelization). -1 uses all available cpus.
+    backend : str, optional
+        `joblib` backend used when `ncpu` is not 1. None defaults to 'loky'.
     **kwargs
-        additional kwargs passed to options specified in `networkx.drawing.layout.spring_layout`.
+        additional kwargs passed to options specified in `networkx.drawing.layout.spring_layout`, and `approximate` to toggle the grid approximated layout used by default for networks of at least 500 cells.
 
     Returns
     -------
@@ -120,45 +132,6 @@ def generate_network(self, key = None, clone_key = None, scale=False, min_size=2
         dat_seq = dat_seq.merge(tmp_dat, left_index = True, right_index = True)
         dat_seq = dat_seq[['heavy'] + [str(c) for c in tmp_dat.columns]]
 
-    # calculate a distance matrix for all vs all and this can be referenced later on to extract the distance between the right pairs
-    dmat = Tree()
-    sleep(0.5)
-    if verbose:
-        for x in tqdm(dat_seq.columns, desc = 'Calculating distances... '):
-            seq_list = []
-            seq_list = [y for y in dat_seq[x]]
-            tdarray = np.array(seq_list).reshape(-1,1)
-            # d_mat = squareform(pdist(tdarray,lambda x,y: levenshtein(x[0],y[0])))
-            d_mat = squareform([levenshtein(x[0],y[0]) for x,y in combinations(tdarray, 2)]) # this is a tad faster than above?
-            dmat[x] = d_mat
-    else:
-        for x in dat_seq.columns:
-            seq_list = []
-            seq_list = [y for y in dat_seq[x]]
-            tdarray = np.array(seq_list).reshape(-1,1)
-            # d_mat = squareform(pdist(tdarray,lambda x,y: levenshtein(x[0],y[0])))
-            d_mat = squareform([levenshtein(x[0],y[0]) for x,y in combinations(tdarray, 2)]) # this is a tad faster than above?
-            dmat[x] = d_mat
-
-    dist_mat_list = [dmat[x] for x in dmat if type(dmat[x]) is np.ndarray]
-
-    n_ = len(dist_mat_list)    
-    if scale:
-        weighted_matrix = []
-        if weights is None:
-            for w in range(0, n_):
-                weighted_matrix.append(1/n_ * dist_mat_list[w])
-            total_dist = sum(weighted_matrix)
-        else:
-            if len(weights) == n_:
-                for w in range(0, n_):
-                    weighted_matrix.append(weights[w] * dist_mat_list[w])
-                total_dist = sum(weighted_matrix)
-            else:
-                raise IndexError('Length of provided weights should be %s.' % int(n_))
-    else:
-        total_dist = np.sum(dist_mat_list,axis=0)
-
     # generate edge list
     if self.__class__ == Dandelion:
         out = self.copy()
@@ -173,135 +146,49 @@ def generate_network(self, key = None, clone_key = None, scale=False, min_size=2
         downsample_meta = self.metadata[self.metadata.index.isin(dat_h['cell_id'])].copy()
         out = Dandelion(dat_downsample, metadata = downsample_meta)
 
-    tmp_totaldist = pd.DataFrame(total_dist, index = out.metadata.index, columns = out.metadata.index)
-    tmp_clusterdist = Tree()
-    overlap = []
-    for i in out.metadata.index:
-        if len(out.metadata.loc[i, str(clonekey)].split('|'))>1:
-            overlap.append([c for c in out.metadata.loc[i, str(clonekey)].split('|')])
-            for c in out.metadata.loc[i, str(clonekey)].split('|'):
-                tmp_clusterdist[c][i].value = 1
-        else:
-            cx = out.metadata.loc[i, str(clonekey)]
-            tmp_clusterdist[cx][i].value = 1
-    tmp_clusterdist2 = {}
-    for x in tmp_clusterdist:
-        tmp_clusterdist2[x] = list(tmp_clusterdist[x])
-    cluster_dist = {}
-    for c_ in tmp_clusterdist2:
-        if c_ in list(flatten(overlap)):
-            for ol in overlap:
-                if c_ in ol:
-                    idx = list(set(flatten([tmp_clusterdist2[c_x] for c_x in ol])))
-                    if len(list(set(idx))) > 1:
-                        dist_mat_ = tmp_totaldist.loc[idx, idx]
-                        s1, s2 = dist_mat_.shape
-                        if s1 > 1 and s2 >1:
-                            cluster_dist['|'.join(ol)] = dist_mat_
-        else:
-            dist_mat_ = tmp_totaldist.loc[tmp_clusterdist2[c_], tmp_clusterdist2[c_]]
-            s1, s2 = dist_mat_.shape
-            if s1 > 1 and s2 >1:
-                cluster_dist[c_] = dist_mat_
-
-    # to improve the visulisation and plotting efficiency, i will build a minimum spanning tree for each group/clone to connect the shortest path
-    mst_tree = mst(cluster_dist)
-    sleep(0.5)
-
-    edge_list = Tree()
-    if verbose:
-        for c in tqdm(mst_tree, desc = 'Generating edge list '):
-            G = nx.from_pandas_adjacency(mst_tree[c])
-            edge_list[c] = nx.to_pandas_edgelist(G)
+    if distance_key is not None:
+        # the pairs stored by find_clones are used as they are, nothing is recomputed
+        if self.__class__ != Dandelion or self.distance is None or distance_key not in self.distance:
+            raise KeyError('{} not found in .distance. Please run find_clones with store_distance = True.'.format(distance_key))
+        dmat = self.distance
+        edge_list_final = _stored_distance_edges(self.distance[distance_key], self.metadata.index, out.metadata, clonekey)
     else:
-        for c in mst_tree:
-            G = nx.from_pandas_adjacency(mst_tree[c])
-            edge_list[c] = nx.to_pandas_edgelist(G)
-
-    sleep(0.5)
-
-    clone_ref = dict(out.metadata[clonekey])
-    tmp_clone_tree = Tree()
-    for x in out.metadata.index:
-        if '|' in clone_ref[x]:
-            for x_ in clone_ref[x].split('|'):
-                tmp_clone_tree[x_][x].value = 1
-        else:
-            tmp_clone_tree[clone_ref[x]][x].value = 1
-    tmp_clone_tree2 = Tree()
-    for x in tmp_clone_tree:
-        tmp_clone_tree2[x] = list(tmp_clone_tree[x])
-
-    tmp_clone_tree3 = Tree()
-    tmp_clone_tree3_overlap = Tree()
-    for x in tmp_clone_tree2:
-        if x in list(flatten(overlap)): # this is to catch all possible cells that may potentially match up with this clone that's joined together
-            for ol in overlap:
-                if x in ol:
-                    if len(tmp_clone_tree2[x]) > 1:
-                        for x_ in tmp_clone_tree2[x]:
-                            tmp_clone_tree3_overlap['|'.join(ol)][''.join(x_)].value = 1
-                    else:
-                        tmp_clone_tree3_overlap['|'.join(ol)][''.join(tmp_clone_tree2[x])].value = 1
+        # cells are only ever linked within clones, with '|' joined overlapping clones merged into one group,
+        # so distances are only calculated for the pairs of cells that share a group and stored as sparse matrices
+        groups = _clone_groups(out.metadata[clonekey])
+        source, target = _group_pairs(groups)
+        n = out.metadata.shape[0]
+        dat_seq = dat_seq.reindex(out.metadata.index)
+        dmat = Tree()
+        sleep(0.5)
+        for x in tqdm(dat_seq.columns, desc = 'Calculating distances... ', disable = not verbose):
+            # missing chains are compared as 'nan', as they were in the all vs all matrices
+            seqs = [str(y) for y in dat_seq[x]]
+            dmat[x] = _pairs_to_csr(source, target, _levenshtein_pairs(seqs, source, target, max_distance = max_distance, ncpu = ncpu, backend = backend), n)
+
+        dist_mat_list = [dmat[x] for x in dmat if type(dmat[x]) is csr_matrix]
+
+        n_ = len(dist_mat_list)
+        if scale:
+            weighted_matrix = []
+            if weights is None:
+                for w in range(0, n_):
+                    weighted_matrix.append(1/n_ * dist_mat_list[w])
+                total_dist = sum(weighted_matrix)
+            else:
+                if len(weights) == n_:
+                    for w in range(0, n_):
+                        weighted_matrix.append(weights[w] * dist_mat_list[w])
+                    total_dist = sum(weighted_matrix)
+                else:
+                    raise IndexError('Length of provided weights should be %s.' % int(n_))
         else:
-            tmp_ = pd.DataFrame(index = tmp_clone_tree2[x], columns = tmp_clone_tree2[x])
-            tmp_ = pd.DataFrame(np.tril(tmp_) + 1, index = tmp_clone_tree2[x], columns = tmp_clone_tree2[x])
-            tmp_.fillna(0, inplace = True)
-            tmp_clone_tree3[x] = tmp_
-
-    for x in tmp_clone_tree3_overlap: # repeat for the overlap clones
-        tmp_ = pd.DataFrame(index = tmp_clone_tree3_overlap[x], columns = tmp_clone_tree3_overlap[x])
-        tmp_ = pd.DataFrame(np.tril(tmp_) + 1, index = tmp_clone_tree3_overlap[x], columns = tmp_clone_tree3_overlap[x])
-        tmp_.fillna(0, inplace = True)
-        tmp_clone_tree3[x] = tmp_
-
-    # here I'm using a temporary edge list to catch all cells that were identified as clones to forcefully link them up if they were identical but clipped off during the mst step
-
-    # create a dataframe to recall the actual distance quickly
-    tmp_totaldiststack = pd.DataFrame(tmp_totaldist.unstack())
-    tmp_totaldiststack.index.names = [None, None]
-    tmp_totaldiststack = tmp_totaldiststack.reset_index(drop = False)
-    tmp_totaldiststack.columns = ['source', 'target', 'weight']
-    tmp_totaldiststack.index = [str(s)+'|'+str(t) for s, t in zip(tmp_totaldiststack['source'], tmp_totaldiststack['target'])]
-
-    tmp_edge_list = Tree()
-    if verbose:
-        for c in tqdm(tmp_clone_tree3, desc = 'Linking edges '):
-            if len(tmp_clone_tree3[c]) > 1:
-                G = nx.from_pandas_adjacency(tmp_clone_tree3[c])
-                tmp_edge_list[c] = nx.to_pandas_edgelist(G)
-                tmp_edge_list[c].index = [str(s)+'|'+str(t) for s, t in zip(tmp_edge_list[c]['source'], tmp_edge_list[c]['target'])]
-                tmp_edge_list[c]['weight'].update(tmp_totaldiststack['weight'])
-                tmp_edge_list[c] = tmp_edge_list[c][tmp_edge_list[c]['weight'] == 0] # keep only edges when there is 100% identity, to minimise crowding
-                tmp_edge_list[c].reset_index(inplace = True)
-    else:
-        for c in tmp_clone_tree3:
-            if len(tmp_clone_tree3[c]) > 1:
-                G = nx.from_pandas_adjacency(tmp_clone_tree3[c])
-                tmp_edge_list[c] = nx.to_pandas_edgelist(G)
-                tmp_edge_list[c].index = [str(s)+'|'+str(t) for s, t in zip(tmp_edge_list[c]['source'], tmp_edge_list[c]['target'])]
-                tmp_edge_list[c]['weight'].update(tmp_totaldiststack['weight'])
-                tmp_edge_list[c] = tmp_edge_list[c][tmp_edge_list[c]['weight'] == 0] # keep only edges when there is 100% identity, to minimise crowding
-                tmp_edge_list[c].reset_index(inplace = True)
-
-    # try to catch situations where there's no edge (only singletons)
-    try:
-        edge_listx = pd.concat([edge_list[x] for x in edge_list])
-        edge_listx.index = [str(s)+'|'+str(t) for s, t in zip(edge_listx['source'],edge_listx['target'])]
-
-        tmp_edge_listx = pd.concat([tmp_edge_list[x] for x in tmp_edge_list])
-        tmp_edge_listx.drop('index', axis = 1, inplace = True)
-        tmp_edge_listx.index = [str(s)+'|'+str(t) for s, t in zip(tmp_edge_listx['source'], tmp_edge_listx['target'])]
-
-        edge_list_final = edge_listx.combine_first(tmp_edge_listx)
+            total_dist = sum(dist_mat_list)
+        total_dist = csr_matrix(total_dist)
 
-        # for idx in edge_list_final.index:
-        #     edge_list_final.at[idx, 'weight'] = tmp_totaldist.loc[idx.split('|')[0], idx.split('|')[1]]
-        edge_list_final['weight'].update(tmp_totaldiststack['weight'])
-        # return the edge list
-        edge_list_final.reset_index(drop = True, inplace = True)
-    except:
-        edge_list_final = None
+        # to improve the visulisation and plotting efficiency, i will build a minimum spanning tree for each group/clone to connect the shortest path
+        # and forcefully link up cells that are identical but were clipped off during the mst step
+        edge_list_final = _clone_edges(total_dist, groups, source, target, out.metadata.index, ncpu = ncpu, backend = backend, verbose = verbose)
 
     # and finally the vertex list which is super easy
     vertice_list = list(out.metadata.index)
@@ -343,23 +230,174 @@ def generate_network(self, key = None, clone_key = None, scale=False, min_size=2
         out = Dandelion(data = dat, distance = dmat, edges = edge_list_final, layout = (lyt, lyt_), graph = (g, g_), clone_key = clone_key)
         return(out)
 
-def mst(mat):
+def _clone_groups(clones):
+    """
+    Groups cells by clone for network construction.
+
+    Parameters
+    ----------
+    clones : Series
+        clone of each cell. Cells that belong to several clones are '|' joined, e.g. 'A|B'.
+
+    Returns
+    -------
+    dictionary of {group : numpy array of cell positions}. Clones that overlap with other clones are merged into a group named after the '|' joined clones, e.g. 'A|B' holds the cells of A and of B.
+    """
+    members, overlap = {}, {}
+    for i, c in enumerate(clones):
+        cs = str(c).split('|')
+        if len(cs) > 1:
+            overlap.setdefault('|'.join(cs), cs)
+        for x in cs:
+            members.setdefault(x, []).append(i)
+    in_overlap = set(flatten(list(overlap.values())))
+    groups = {c:np.array(members[c]) for c in members if c not in in_overlap}
+    for ol, cs in overlap.items():
+        groups[ol] = np.unique(np.concatenate([members[c] for c in cs]))
+    return(groups)
+
+def _group_pairs(groups):
+    """
+    Lists the pairs of cells that share a group.
+
+    Parameters
+    ----------
+    groups : dict
+        dictionary of {group : numpy array of cell positions}.
+
+    Returns
+    -------
+    tuple of source and target cell positions with source < target. Pairs shared by several groups are listed once.
+    """
+    source, target = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)]
+    for idx in groups.values():
+        if len(idx) > 1:
+            i, j = np.triu_indices(len(idx), 1)
+            source.append(idx[i])
+            target.append(idx[j])
+    source, target = np.concatenate(source), np.concatenate(target)
+    pairs = np.unique(np.stack([np.minimum(source, target), np.maximum(source, target)], axis = 1), axis = 0)
+    return(pairs[:, 0], pairs[:, 1])
+
+def _pairs_to_csr(source, target, dist, n):
+    """
+    Symmetric n x n sparse matrix from a list of pairs. Pairs with a distance of 0 are kept as explicit zeros.
+    """
+    return(coo_matrix((np.concatenate([dist, dist]), (np.concatenate([source, target]), np.concatenate([target, source]))), shape = (n, n)).tocsr())
+
+def _clone_edges(dist, groups, source, target, index, ncpu = None, backend = None, verbose = True):
     """
-    Construct minimum spanning tree based on supplied matrix in dictionary.
+    Constructs the network edges from the distances within each group of cells.
 
     Parameters
     ----------
-    mat : dict
-        Dictionary containing numpy ndarrays.
+    dist : csr_matrix
+        symmetric cell x cell distance matrix.
+    groups : dict
+        dictionary of {group : numpy array of cell positions} from `_clone_groups`.
+    source, target : ndarray
+        positions of the pairs of cells that share a group, from `_group_pairs`.
+    index : Index
+        cell ids of the rows and columns of `dist`.
+    ncpu : int, optional
+        number of workers building the minimum spanning trees. None defaults to 1 (no parallelization). -1 uses all available cpus.
+    backend : str, optional
+        `joblib` backend used when `ncpu` is not 1. None defaults to 'loky'.
+    verbose : bool
+        whether or not to print the progress bar.
 
     Returns
     -------
-    Dandelion `Tree` object holding DataFrames of constructed minimum spanning trees.
+    pandas DataFrame of edges with source, target and weight columns, or None if there are no edges.
+    """
+    blocks = [(idx, dist[idx][:, idx]) for idx in groups.values() if len(idx) > 1]
+    n_jobs = 1 if ncpu is None else effective_n_jobs(int(ncpu))
+    if n_jobs == 1 or len(blocks) < 2:
+        edges = [_mst_edges([b]) for b in tqdm(blocks, desc = 'Generating edge list ', disable = not verbose)]
+    else:
+        if backend is None:
+            backend = 'loky'
+        batches = _balanced_batches([len(idx) for idx, _ in blocks], n_jobs * 4)
+        edges = Parallel(n_jobs = n_jobs, backend = backend)(delayed(_mst_edges)([blocks[i] for i in b]) for b in tqdm(batches, desc = 'Generating edge list ', disable = not verbose))
+    # cells with identical sequences, i.e. pairs sharing a group without a distance, are always linked
+    identical = np.asarray(dist[source, target]).ravel() == 0 if len(source) > 0 else np.zeros(0, dtype = bool)
+    edges = np.concatenate([np.zeros((2, 0), dtype = np.int64)] + edges + [np.stack([source[identical], target[identical]])], axis = 1)
+    if edges.shape[1] == 0:
+        return(None)
+    edges = np.unique(np.sort(edges, axis = 0), axis = 1)
+    cells = np.asarray(index)
+    return(pd.DataFrame({'source':cells[edges[0]], 'target':cells[edges[1]], 'weight':np.asarray(dist[edges[0], edges[1]]).ravel()}))
+
+def _mst_edges(blocks):
+    """
+    Minimum spanning tree edges of a list of (cell positions, sparse distance block) tuples, as a 2 x n array of cell positions.
     """
-    mst_tree = Tree()
-    for c in mat:
-        mst_tree[c] = pd.DataFrame(minimum_spanning_tree(np.triu(mat[c])).toarray().astype(int), index = mat[c].index, columns = mat[c].columns)
-    return(mst_tree)
+    edges = [np.zeros((2, 0), dtype = np.int64)]
+    for idx, sub in blocks:
+        sub.eliminate_zeros()
+        tree = minimum_spanning_tree(triu(sub)).tocoo()
+        edges.append(np.stack([idx[tree.row], idx[tree.col]]))
+    return(np.concatenate(edges, axis = 1))
+
+def _balanced_batches(sizes, n_batches):
+    """
+    Splits groups into batches of similar cost, taken as the number of cell pairs, by adding the largest remaining group to the cheapest batch.
+    """
+    costs = np.zeros(max(min(n_batches, len(sizes)), 1))
+    batches = [[] for _ in costs]
+    for i in np.argsort(sizes, kind = 'stable')[::-1]:
+        b = int(np.argmin(costs))
+        batches[b].append(i)
+        costs[b] += sizes[i] * (sizes[i] - 1) / 2
+    return([b for b in batches if len(b) > 0])
+
+def _stored_distance_edges(dist, index, metadata, clonekey):
+    """
+    Constructs the network edges from a sparse distance matrix stored in `.distance`.
+
+    Parameters
+    ----------
+    dist : csr_matrix
+        symmetric cell x cell distance matrix where the stored entries, including explicit zeros, are the pairs to consider.
+        Matrices from `tl.find_clones` carry the cell ids of their rows and columns in a `cell_ids` attribute.
+    index : Index
+        cell ids of the rows and columns of `dist`, used if `dist` does not carry its own.
+    metadata : DataFrame
+        metadata of the cells in the network.
+    clonekey : str
+        column name of the clones in `metadata`.
+
+    Returns
+    -------
+    pandas DataFrame of edges with source, target and weight columns, or None if there are no edges.
+    """
+    cells = getattr(dist, 'cell_ids', None)
+    if cells is None:
+        if dist.shape[0] != len(index):
+            raise ValueError('The stored distance matrix has {} rows but there are {} cells. Please rerun find_clones with store_distance = True.'.format(dist.shape[0], len(index)))
+        cells = index
+    # stored pairs are mapped onto the cells in the network, pairs of cells that are no longer there are dropped
+    pos = pd.Index(metadata.index).get_indexer(np.asarray(cells))
+    coo = dist.tocoo()
+    keep = (coo.row < coo.col) & (pos[coo.row] > -1) & (pos[coo.col] > -1)
+    n = metadata.shape[0]
+    # the distances are shifted by 1 so that identical pairs are not mistaken for missing edges in the minimum spanning tree
+    shifted = csr_matrix((coo.data[keep] + 1, (pos[coo.row[keep]], pos[coo.col[keep]])), shape = (n, n))
+    shifted = shifted + shifted.T
+    # as with the calculated distances, each clone, with '|' joined overlapping clones merged, gets its own minimum spanning tree and identical cells are always linked
+    edges = [np.zeros((2, 0), dtype = np.int64)]
+    for idx in _clone_groups(metadata[clonekey]).values():
+        if len(idx) > 1:
+            sub = triu(shifted[idx][:, idx]).tocoo()
+            tree = minimum_spanning_tree(sub).tocoo()
+            identical = sub.data == 1
+            edges.append(np.stack([idx[np.concatenate([tree.row, sub.row[identical]])], idx[np.concatenate([tree.col, sub.col[identical]])]]))
+    edges = np.concatenate(edges, axis = 1)
+    if edges.shape[1] == 0:
+        return(None)
+    edges = np.unique(np.sort(edges, axis = 0), axis = 1)
+    names = np.asarray(metadata.index)
+    return(pd.DataFrame({'source':names[edges[0]], 'target':names[edges[1]], 'weight':np.asarray(shifted[edges[0], edges[1]]).ravel().astype(int) - 1}))
 
 def clone_degree(self, weight=None, verbose = True):
     """
@@ -500,6 +538,7 @@ def _fruchterman_reingold_layout(
     center=None,
     dim=2,
     seed=None,
+    approximate=None,
 ):
     """Position nodes using Fruchterman-Reingold force-directed algorithm.
     The algorithm simulates a force-directed representation of the network
@@ -553,6 +592,12 @@ def _fruchterman_reingold_layout(
         number generator,
         if None, the random number generator is the RandomState instance used
         by numpy.random.
+    approximate : bool or None  optional (default=None)
+        Whether to approximate the repulsion between nodes on a hierarchy of grids
+        (Barnes-Hut style) and calculate the attraction along the edges only.
+        Each iteration then takes O(n log n) time and memory instead of O(n^2).
+        If None, the approximation is used for graphs with at least
+        `APPROXIMATE_LAYOUT_MIN_SIZE` nodes.
 
     Returns
     -------
@@ -597,18 +642,26 @@ def _fruchterman_reingold_layout(
     if len(G) == 1:
         return {nx.utils.arbitrary_element(G.nodes()): center}
 
+    if approximate is None:
+        approximate = len(G) >= APPROXIMATE_LAYOUT_MIN_SIZE
+
     try:
         # Sparse matrix
-        if len(G) < 500:  # sparse solver for large graphs
+        if len(G) < 500 and not approximate:  # sparse solver for large graphs
             raise ValueError
         A = nx.to_scipy_sparse_matrix(G, weight=weight, dtype="f")
         if k is None and fixed is not None:
             # We must adjust k by domain size for layouts not near 1x1
             nnodes, _ = A.shape
             k = dom_size / np.sqrt(nnodes)
-        pos = _sparse_fruchterman_reingold(
-            A, k, pos_arr, fixed, iterations, threshold, dim, seed
-        )
+        if approximate:
+            pos = _grid_fruchterman_reingold(
+                A, k, pos_arr, fixed, iterations, threshold, dim, seed
+            )
+        else:
+            pos = _sparse_fruchterman_reingold(
+                A, k, pos_arr, fixed, iterations, threshold, dim, seed
+            )
     except ValueError:
         A = nx.to_numpy_array(G, weight=weight)
         if k is None and fixed is not None:
@@ -762,6 +815,111 @@ def _sparse_fruchterman_reingold(
             break
     return pos
 
+@random_state(7)
+def _grid_fruchterman_reingold(
+    A, k=None, pos=None, fixed=None, iterations=50, threshold=1e-4, dim=2, seed=None
+):
+    # Position nodes in adjacency matrix A using Fruchterman-Reingold
+    # Entry point for NetworkX graph is fruchterman_reingold_layout()
+    # Approximate version for large graphs: the repulsion is calculated Barnes-Hut style on a hierarchy of grids, where
+    # nodes in neighbouring cells of the finest grid repel each other exactly and cells further away act through their
+    # centroid, and the attraction is only calculated along the edges. Each iteration is O(V log V + E) rather than O(V^2).
+    try:
+        nnodes, _ = A.shape
+    except AttributeError as e:
+        msg = "fruchterman_reingold() takes an adjacency matrix as input"
+        raise nx.NetworkXError(msg) from e
+    A = coo_matrix(A)
+    row, col, w = A.row, A.col, A.data.astype(float)
+
+    if pos is None:
+        # random initial positions
+        pos = np.asarray(seed.rand(nnodes, dim), dtype=float)
+    else:
+        pos = pos.astype(float)
+
+    # optimal distance between nodes
+    if k is None:
+        k = np.sqrt(1.0 / nnodes)
+    # the initial "temperature"  is about .1 of domain area (=1x1)
+    # this is the largest step allowed in the dynamics.
+    t = max(max(pos.T[0]) - min(pos.T[0]), max(pos.T[1]) - min(pos.T[1])) * 0.1
+    # simple cooling scheme.
+    # linearly step down by dt on each iteration so last iteration is size dt.
+    dt = t / float(iterations + 1)
+
+    # number of grid levels so that the finest grid holds about LAYOUT_LEAF_SIZE nodes per cell
+    levels = max(int(np.ceil(np.log2(max(nnodes / LAYOUT_LEAF_SIZE, 1)) / dim)), 1)
+    near = np.array(np.meshgrid(*[[-1, 0, 1]] * dim, indexing = 'ij')).reshape(dim, -1).T
+    # cells whose parents neighbour the parent of a node's cell, but that do not neighbour the cell itself, for each parity of the cell
+    far = {}
+    for parity in np.array(np.meshgrid(*[[0, 1]] * dim, indexing = 'ij')).reshape(dim, -1).T:
+        o = np.array(np.meshgrid(*[np.arange(-2 - p, 4 - p) for p in parity], indexing = 'ij')).reshape(dim, -1).T
+        far[tuple(parity)] = o[np.abs(o).max(axis = 1) > 1]
+
+    for iteration in range(iterations):
+        displacement = np.zeros((nnodes, dim))
+        lo = pos.min(axis = 0)
+        size = max((pos.max(axis = 0) - lo).max(), 1e-12) * (1 + 1e-9)
+        for level in range(2, levels + 1):
+            m = 2 ** level
+            cell = np.clip(((pos - lo) / size * m).astype(int), 0, m - 1)
+            flat = np.ravel_multi_index(cell.T, (m,) * dim)
+            count = np.bincount(flat, minlength = m ** dim).astype(float)
+            centroid = np.stack([np.bincount(flat, weights = pos[:, d], minlength = m ** dim) for d in range(dim)], axis = 1) / np.maximum(count, 1)[:, np.newaxis]
+            code = np.ravel_multi_index((cell % 2).T, (2,) * dim)
+            for parity, offsets in far.items():
+                nodes = np.flatnonzero(code == np.ravel_multi_index(parity, (2,) * dim))
+                if len(nodes) == 0:
+                    continue
+                target = cell[nodes][:, np.newaxis, :] + offsets[np.newaxis, :, :]
+                valid = ((target >= 0) & (target < m)).all(axis = 2)
+                tflat = np.ravel_multi_index(np.clip(target, 0, m - 1).transpose(2, 0, 1), (m,) * dim)
+                mass = np.where(valid, count[tflat], 0)
+                delta = pos[nodes][:, np.newaxis, :] - centroid[tflat]
+                distance2 = np.clip((delta ** 2).sum(axis = 2), 1e-6, None)
+                displacement[nodes] += (delta * (mass * k * k / distance2)[:, :, np.newaxis]).sum(axis = 1)
+        # exact repulsion between nodes in neighbouring cells of the finest grid
+        m = 2 ** levels
+        cell = np.clip(((pos - lo) / size * m).astype(int), 0, m - 1)
+        flat = np.ravel_multi_index(cell.T, (m,) * dim)
+        order = np.argsort(flat, kind = 'stable')
+        count = np.bincount(flat, minlength = m ** dim)
+        starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+        for offset in near:
+            target = cell + offset
+            valid = ((target >= 0) & (target < m)).all(axis = 1)
+            tflat = np.ravel_multi_index(np.clip(target, 0, m - 1).T, (m,) * dim)
+            reps = np.where(valid, count[tflat], 0)
+            i = np.repeat(np.arange(nnodes), reps)
+            j = order[np.repeat(starts[tflat] - np.cumsum(reps) + reps, reps) + np.arange(reps.sum())]
+            delta = pos[i] - pos[j]
+            distance = np.clip(np.sqrt((delta ** 2).sum(axis = 1)), 0.001, None)
+            f = k * k / distance ** 2
+            for d in range(dim):
+                displacement[:, d] += np.bincount(i, weights = delta[:, d] * f, minlength = nnodes)
+        # attraction along the edges
+        delta = pos[row] - pos[col]
+        distance = np.clip(np.sqrt((delta ** 2).sum(axis = 1)), 0.001, None)
+        f = w * distance / k
+        for d in range(dim):
+            displacement[:, d] -= np.bincount(row, weights = delta[:, d] * f, minlength = nnodes)
+        displacement = displacement - pos / ( k * np.sqrt(nnodes))
+        # update positions
+        length = np.linalg.norm(displacement, axis=-1)
+        length = np.where(length < 0.01, 0.1, length)
+        delta_pos = np.einsum("ij,i->ij", displacement, t / length)
+        if fixed is not None:
+            # don't change positions of fixed nodes
+            delta_pos[fixed] = 0.0
+        pos += delta_pos
+        # cool temperature
+        t -= dt
+        err = np.linalg.norm(delta_pos) / nnodes
+        if err < threshold:
+            break
+    return pos
+
 def _rescale_layout(pos, scale=1):
     """
     Returns scaled position array to (-scale, scale) in all axes.
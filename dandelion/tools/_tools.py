@@ -11,14 +11,15 @@ import pandas as pd
 import numpy as np
 from tqdm import tqdm
 from ..utilities._utilities import *
+from ..utilities._utilities import _map_categories, _normalise_gene_calls
 from ._network import *
+from ._distance import _collapse_junctions, _encode_junctions, _expand_pairs, _indel_pairs, _nearest_rows, _neighbour_pairs, _parse_memory, _union_find
 from collections import defaultdict
 from itertools import groupby
-from scipy.spatial.distance import pdist, squareform
-from scipy.sparse import csr_matrix
-from distance import hamming
+from scipy.sparse import csr_matrix, coo_matrix
 import re
 import math
+import hashlib
 import networkx as nx
 from time import sleep
 import copy
@@ -28,12 +29,12 @@ try:
 except ImportError:
     pass
 import warnings
-from subprocess import run
 import multiprocessing
+from joblib import Parallel, delayed
 from changeo.Gene import getGene
 from anndata import AnnData
 
-def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = False, key_added = None, recalculate_length = True):
+def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = False, key_added = None, recalculate_length = True, incremental = False, clone_index = None, ncpu = None, backend = None, max_memory = None, linkage = None, paired = False, indel = 0, hash_ids = False, store_distance = False):
     """
     Find clones based on heavy chain and light chain CDR3 junction hamming distance.
 
@@ -41,8 +42,8 @@ def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = Fals
     ----------
     self : Dandelion, DataFrame, str
         `Dandelion` object, pandas `DataFrame` in changeo/airr format, or file path to changeo/airr file after clones have been determined.
-    identity : float
-        Junction similarity parameter. Default 0.85
+    identity : float, list
+        Junction similarity parameter. Default 0.85. A list of values performs a threshold sweep: the distances are computed once, clones are called with single linkage at every identity and written to one column per value, e.g. 'clone_id_0.85'.
     key : str, optional
         column name for performing clone clustering. None defaults to 'junction_aa'.
     locus : str, optional
@@ -53,16 +54,41 @@ def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = Fals
         If specified, this will be the column name for clones. None defaults to 'clone_id'
     recalculate_length : bool
         Whether or not to re-calculate junction length, rather than rely on parsed assignment (which occasionally is wrong). Default is True
+    incremental : bool
+        Whether or not to only assign clones to contigs without a clone id, e.g. after concatenating new samples to an object that was already processed with `find_clones`. Existing clone ids are kept unchanged and new contigs are compared against the existing members of their V/J/length partitions. Default is False.
+    clone_index : CloneIndex, optional
+        clone index from `tl.build_clone_index` or `tl.read_clone_index`. Only used if `incremental` is True, in which case the existing members of each partition are looked up in the index instead of being rebuilt from the `.data` table. The index must match the clonally assigned contigs in `.data` and is updated in place with the new assignments; write it back with `CloneIndex.write` for the next session.
+    ncpu : int, optional
+        number of cpus for processing the V/J/length partitions in parallel. None defaults to 1 (no parallelization). -1 uses all available cpus.
+    backend : str, optional
+        `joblib` backend used when `ncpu` is not 1. None defaults to 'loky' (process pool). Also accepts 'multiprocessing' and 'threading'.
+    max_memory : int, str, optional
+        memory budget for comparing the junctions of a partition, in bytes or as a string e.g. '4GB'. Partitions are compared in blocks of rows that fit in the budget and only the pairs within the threshold are kept, so the full distance matrix is never created. The budget applies per worker when `ncpu` is not 1. None defaults to 64MB.
+    linkage : str, optional
+        how junctions within the threshold are grouped into clones. None uses the default grouping, where the closest junctions of a partition form one clone and the remaining junctions within the threshold form a second one. 'single' performs single linkage clustering, where junctions connected through any chain of pairs within the threshold belong to the same clone.
+    paired : bool
+        Whether or not to call clones on heavy and light chains jointly. Cells are partitioned by heavy chain V/J/junction length together with light chain V/J/junction length, and the junction distance is the sum of the heavy and light chain distances, with the threshold set on the combined length. Clones are not refined by light chains afterwards. Cells with multiple light chains are paired with the light chain with the highest umi count, and cells without light chains are partitioned on their heavy chain only. Default is False.
+    indel : int
+        maximum difference in junction length for junctions to be compared. If above 0, junctions of the same V/J genes whose lengths differ by up to `indel` are compared with a banded edit distance (same length junctions are still compared by hamming distance), with the threshold set by the longer junction, and clones are called with single linkage. Clones are numbered under the shortest junction length of their members. Default is 0 (only junctions of the same length are compared).
+    hash_ids : bool
+        Whether or not to name heavy chain clones with a hash of their V/J/length partition and their representative (lexicographically smallest) junction instead of numbering them, e.g. '5f3c0a9d1e2b7c48_1' rather than '1_2_3_1'. Clone ids then only depend on the contents of the clone, so clones called separately, e.g. on subsets of V/J groups, can be concatenated without renumbering. Default is False.
+    store_distance : bool
+        Whether or not to keep the junction distances computed for clone calling. If True, the junction pairs within the threshold are stored in `.distance['junction']` as a symmetric cell x cell sparse matrix, with identical junctions stored as explicit zeros. The distances are those of the heavy chain junctions, or the sum of the heavy and light chain junction distances with `paired = True`. The cell ids of the rows and columns are kept in its `cell_ids` attribute, so the matrix stays valid if the object is subset later. It can be passed to `tl.generate_network` with `distance_key = 'junction'`. Not supported in incremental mode. Default is False.
     
     Returns
     -------
     `Dandelion` object with clone_id annotated in `.data` slot and `.metadata` initialized.
     """
     start = logg.info('Finding clonotypes')
+    max_memory = _parse_memory(max_memory)
+    if linkage not in [None, 'single']:
+        raise ValueError("linkage must be None or 'single'.")
     if self.__class__ == Dandelion:
         dat = load_data(self.data)
+        memo = getattr(self, '_gene_call_memo', {})
     else:
         dat = load_data(self)
+        memo = {}
 
     locus_dict = {'bcr':'IGH', 'BCR':'IGH', 'ig':'IGH'}
 
@@ -90,42 +116,58 @@ def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = Fals
     else:
         clone_key = key_added
 
-    # retrieve the J genes and J genes
-    if not by_alleles:
-        if 'v_call_genotyped' in dat_heavy.columns:
-            V = [re.sub('[*][0-9][0-9]', '', v) for v in dat_heavy['v_call_genotyped']]
-        else:
-            V = [re.sub('[*][0-9][0-9]', '', v) for v in dat_heavy['v_call']]
-        J = [re.sub('[*][0-9][0-9]', '', j) for j in dat_heavy['j_call']]
+    if isinstance(identity, (list, tuple, np.ndarray)):
+        # threshold sweep, the distances are computed once and the single linkage clones are cut at every identity
+        if incremental:
+            raise ValueError("Incremental mode does not support a list of identity values.")
+        identities = [float(i) for i in identity]
+        clone_keys = ['{}_{}'.format(clone_key, i) for i in identities]
+        linkage = 'single'
     else:
-        if 'v_call_genotyped' in dat_heavy.columns:
-            V = [v for v in dat_heavy['v_call_genotyped']]
-        else:
-            V = [v for v in dat_heavy['v_call']]
-        J = [j for j in dat_heavy['j_call']]    
-
-    # collapse the alleles to just genes
-    V = [','.join(list(set(v.split(',')))) for v in V]
-    J = [','.join(list(set(j.split(',')))) for j in J]    
-
-    seq = dict(zip(dat_heavy.index, dat_heavy[key_]))
-    if recalculate_length:
-        seq_length = [len(str(l)) for l in dat_heavy[key_]]
-    else:
-        try:
-            seq_length = [l for l in dat_heavy[key_+'_length']]
-        except:
-            raise ValueError("{} not found in {} input table.".format(key_ + '_length', locus_log1_dict[locus_]))
-    seq_length_dict = dict(zip(dat_heavy.index, seq_length))
+        identities = [identity]
+        clone_keys = [clone_key]
+    if paired and incremental:
+        raise ValueError("Incremental mode does not support paired clone calling.")
+    if store_distance and incremental:
+        raise ValueError("Incremental mode does not support store_distance.")
+    if indel:
+        if incremental or paired or len(identities) > 1:
+            raise ValueError("indel is not supported with incremental mode, paired clone calling or a list of identity values.")
+        linkage = 'single'
+
+    dat_part = dat_heavy
+    if incremental:
+        if clone_key not in dat.columns:
+            raise ValueError("Incremental mode requires {} in the input table. Please run find_clones first.".format(clone_key))
+        assigned = ~(pd.isnull(dat[clone_key]) | dat[clone_key].isin(['', 'nan', 'None', 'unassigned']))
+        existing_clones = dict(zip(dat_heavy.index[assigned[dat_heavy.index]], dat_heavy.loc[assigned[dat_heavy.index], clone_key]))
+        if clone_index is not None:
+            if (clone_index.params.get('key', key_) != key_) or (clone_index.params.get('by_alleles', by_alleles) != by_alleles):
+                raise ValueError("clone_index was built with key = {} and by_alleles = {}.".format(clone_index.params.get('key'), clone_index.params.get('by_alleles')))
+            clone_index.validate(dat_heavy[assigned[dat_heavy.index]], clone_key)
+            # existing clones are looked up in the index so only the new contigs need to be partitioned
+            dat_part = dat_heavy[~assigned[dat_heavy.index]]
+
+    # retrieve the V genes and J genes
+    V, J = _gene_calls(dat_part, by_alleles, memo)
+
+    seq = dict(zip(dat_part.index, dat_part[key_]))
+    seq_length = _junction_lengths(dat_part, key_, recalculate_length, locus_log1_dict[locus_])
+    seq_length_dict = dict(zip(dat_part.index, seq_length))
 
     # Create a dictionary and group sequence ids with same V and J genes
-    V_J = dict(zip(dat_heavy.index, zip(V,J)))
+    V_J = dict(zip(dat_part.index, zip(V,J)))
+    if paired:
+        # partitions also split on the light chain V/J/length, and the junctions are joined so that their distance is the sum of both chains
+        Vlight, Jlight, seq_light, seq_length_light = _pair_light_chains(dat, dat_part, locus_, key_, by_alleles, recalculate_length, memo)
+        V_J = {k:V_J[k] + (Vlight[k], Jlight[k]) for k in V_J}
+        seq = {k:str(seq[k]) + seq_light[k] for k in seq}
+        seq_length_dict = {k:(int(seq_length_dict[k]), seq_length_light[k]) for k in seq_length_dict}
     vj_grp = defaultdict(list)
     for key, val in sorted(V_J.items()):
         vj_grp[val].append(key)
     # and now we split the groups based on lengths of the seqs
     vj_len_grp = Tree()
-    seq_grp = Tree()
     for g in vj_grp:
         # first, obtain what's the unique lengths
         jlen = []
@@ -139,366 +181,73 @@ def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = Fals
                 jlen_ = seq_length_dict[contig_id]
                 if jlen_ == s:
                     vj_len_grp[g][s][contig_id].value = 1
-                    seq_grp[g][s][seq[contig_id]].value = 1
                     for c in [contig_id]:
                         vj_len_grp[g][s][c] = seq[c]
-    clones = Tree()
-    # for each seq group, calculate the hamming distance matrix
-    for g in tqdm(seq_grp, desc = 'Finding clones based on heavy chains '):
-        for l in seq_grp[g]:
-            seq_ = list(seq_grp[g][l])
-            tdarray = np.array(seq_).reshape(-1,1)            
-            d_mat = squareform(pdist(tdarray, lambda x,y: hamming(x[0],y[0])))
-            # then calculate what the acceptable threshold is for each length of sequence
-            tr = math.floor(int(l)*(1-identity))
-            # convert diagonal and upper triangle to zeroes
-            d_mat = np.tril(d_mat)
-            np.fill_diagonal(d_mat, 0)
-            # get the coordinates/indices of seqs to match against the threshold later
-            indices_temp = []
-            indices = []
-            indices_temp = [list(x) for x in np.tril_indices_from(d_mat)]
-            indices = list(zip(indices_temp[0], indices_temp[1]))
-            # if there's more than 1 contig, remove the diagonal
-            if len(indices) > 1:
-                for pairs in indices:
-                    # remove diagonals
-                    if pairs[0] == pairs[1]:
-                        indices.remove(pairs)
-            indices_j = []
-            # use the coordinates/indices to retrieve the seq sequences
-            for p in range(0, len(indices)):
-                a1, b1 = indices[p]
-                indices_j.append(seq_[a1])
-                indices_j.append(seq_[b1])
-            # retain only the unique sequences
-            indices_j_f = list(set(indices_j))
-            # convert the distance matrix to coordinate (source) and distance (target) and create it as a dictionary
-            source, target = d_mat.nonzero()
-            source_target = list(zip(source.tolist(), target.tolist()))
-            if len(source) == 0 & len(target) == 0:
-                source_target = list([(0,0)])
-            dist = {}
-            for st in source_target:
-                dist.update({st:d_mat[st]})
-            
-            cm1, cm2, cm3 = [], [], []            
-            # now to calculate which contigs to group
-            tr2 = min(dist.values())
-            if tr2 <= tr:
-                for d in dist:
-                    # if the distance is equal to the minimum distance, which is lesser than or equal to the threshold. I will add the sequence to cm1, meaning they passed and should be a clone.
-                    if dist[d] == tr2:
-                        cm1.append(d)
-                    else:
-                        # otherwise add into cm3, which later on will get split into individual clones, despite being part of the acceptable threshold for this group of sequences
-                        cm3.append(d)
+    if incremental:
+        # only the partitions that gain new contigs are compared against their existing members
+        clone_dicts = [_extend_clones(vj_len_grp, existing_clones, identity, clone_index = clone_index, linkage = linkage, hash_ids = hash_ids, max_memory = max_memory)]
+    else:
+        # each partition is reduced to its unique junctions; the distance work only runs on these
+        partitions, members = {}, {}
+        for g in vj_len_grp:
+            if indel:
+                # junctions of all lengths of a V/J group are clustered together
+                contigs = {}
+                for l in vj_len_grp[g]:
+                    contigs.update(vj_len_grp[g][l])
+                partitions[(g, None)], members[(g, None)] = _collapse_partition(contigs)
+                continue
+            for l in vj_len_grp[g]:
+                partitions[(g, l)], members[(g, l)] = _collapse_partition(vj_len_grp[g][l])
+        # the groups are independent of each other
+        cid = [Tree() for ck in clone_keys]
+        pairs = []
+        for (g, l), labels in _cluster_partitions(partitions, identity, ncpu = ncpu, backend = backend, max_memory = max_memory, linkage = linkage, indel = indel, desc = 'Finding clones based on heavy chains ', return_pairs = store_distance).items():
+            # and the clone 'numbers' are broadcast back to the contigs, one row per threshold in a sweep
+            contig_ids, inverse = members[(g, l)]
+            if store_distance:
+                # the pairs of unique junctions are expanded back to the contigs
+                labels, (source, target, dist) = labels
+                source, target, dist = _expand_pairs(inverse, source, target, dist)
+                pairs.append((np.asarray(contig_ids)[source], np.asarray(contig_ids)[target], dist))
+            junctions = np.array(partitions[(g, l)], dtype = object)[inverse]
+            for i, lab in enumerate(np.atleast_2d(labels[..., inverse])):
+                if l is None:
+                    # each clone is numbered under the shortest junction length among its members
+                    lmin = pd.Series(np.array([len(x) for x in partitions[(g, l)]])[inverse]).groupby(lab).transform('min').values
+                    for m in np.unique(lmin):
+                        sel = np.flatnonzero(lmin == m)
+                        cid[i][g][int(m)] = ([contig_ids[x] for x in sel], lab[sel], junctions[sel])
+                else:
+                    cid[i][g][l] = (contig_ids, lab, junctions)
+        clone_dicts = [_number_clones(c, hash_ids) for c in cid]
+
+    for clone_key_, identity_, clone_dict in zip(clone_keys, identities, clone_dicts):
+        # add it to the original dataframes
+        dat_heavy[clone_key_] = pd.Series(clone_dict)
+        hclone = dict(zip(dat_heavy['cell_id'], dat_heavy[clone_key_]))
+        hlclone = dict(zip(dat['sequence_id'], [hclone[c] for c in dat['cell_id']]))
+
+        if incremental:
+            # contigs that were already assigned keep their clone id
+            dat[clone_key_] = dat[clone_key_].where(assigned, pd.Series(hlclone))
+        else:
+            dat[clone_key_] = pd.Series(hlclone)
+        # repeat this process for the light chains within each clone, but only for those with more than 1 light chains in a clone
+        dat_light = dat[~(dat['locus'] == locus_)].copy()
+        if dat_light.shape[0] != 0 and not paired:
+            if incremental:
+                # clones that existed before are extended with their new light chains, the new clones are refined as usual
+                touched = set(dat_light.loc[~assigned[dat_light.index], clone_key_])
+                _extend_light_clones(dat, dat_light, assigned, set(existing_clones.values()) & touched, hclone, key_, clone_key_, identity_, by_alleles, recalculate_length, linkage, memo, max_memory)
+                refine = [c for c in touched if c not in set(existing_clones.values())]
             else:
-                # if the value is greater than the the minimum threshold, I will add the entire group into cm3, so they shouldn't be grouped together as a clone
-                for d in dist:
-                    cm3.append(d)
-            # This is based on a simple scenario e.g. in 3x3 distance matrix where the acceptable distance threshold is 2.
-            # SeqA is 1 sequence different from SeqB
-            # SeqB is 2 sequences different from SeqC
-            # SeqC can only be 2 sequences different from SeqA otherwise it will violate the pair-wise distance matrix calculation
-            # Because the distance between SeqA and SeqB is below the threshold, and is essentially the smallest value, they will be grouped in cm1
-            # While SeqC is below the acceptable threshold, really it's more different than SeqA and SeqB. Therefore, they will be grouped separately.
-            # If there's more than 3 sequences in a particular distance matrix, it gets slightly complicated.
-            # so i repeat the calculation to only catch those with more than 3 sequences
-            if len(dist) > 3:
-                for d in dist:
-                    # This time, i will rely on the main threshold value; if the distance is lesser than the overall threshold, i will add it to cm2.
-                    if dist[d] < tr:
-                        cm2.append(d)
-                    else:
-                        cm3.append(d)
-                # any sequences that were already binned above in cm1, it will be removed from here.
-                cm2 = list(set(cm2) ^ set(cm1))
-                cm3 = list(set(cm3) ^ set(cm1))
-
-            # now to actually retrieve the seq/contigs properly through a series of appending and removing
-            j_list1 = []
-            if len(cm1) > 0:
-                for i in range(0, len(cm1)):
-                    a, b = cm1[i]
-                    j_list1.append(seq_[a])
-                    j_list1.append(seq_[b])
-                j_list1 = list(set(j_list1))
-
-            j_list2 = []
-            if len(cm3) > 0:
-                for i in range(0, len(cm2)):
-                    a, b = cm2[i]
-                    j_list2.append(seq_[a])
-                    j_list2.append(seq_[b])
-                j_list2 = list(set(j_list2))
-
-            j_list3 = []
-            if len(cm3) > 0:
-                for i in range(0, len(cm3)):
-                    a, b = cm3[i]
-                    j_list3.append(seq_[a])
-                    j_list3.append(seq_[b])
-                j_list3 = list(set(j_list3))
-
-            # this is to catch the overlapping seqs appearing in the lists because of the sequential appending
-            for jl3_1 in j_list1:
-                if jl3_1 in j_list3:
-                    j_list3.remove(jl3_1)
-            for jl2_1 in j_list1:
-                if jl2_1 in j_list2:
-                    j_list2.remove(jl2_1)
-            for jl3_2 in j_list2:
-                if jl3_2 in j_list3:
-                    j_list3.remove(jl3_2)
-
-            j_list3 = [i.split() for i in list(set(j_list3))]
-
-            if len(j_list1) > 0:
-                clones[g][l][str(0)] = j_list1
-            if len(j_list2) > 0:
-                clones[g][l][str(1)] = j_list2
-            if len(j_list3) > 0:
-                for c in range(0, len(j_list3)):
-                    # the +2 here is so that the numbers come up after 1. It doesn't matter because i will reformat the clone ID numbers later
-                    clones[g][l][str(c+2)] = j_list3[c]
+                refine = list(set(dat_light[clone_key_]))
+            _refine_light_chains(dat, dat_light, refine, clone_key_, key_, identity_, by_alleles, recalculate_length, locus_log2_dict[locus_], ncpu = ncpu, backend = backend, max_memory = max_memory, linkage = linkage, memo = memo)
 
-    clone_dict = {}
-    # now to retrieve the contig ids that are grouped together
-    cid = Tree()
-    for g in clones:
-        for l in clones[g]:
-            # retrieve the clone 'numbers'
-            for c in clones[g][l]:
-                grp_seq = clones[g][l][c]
-                for key, value in vj_len_grp[g][l].items():
-                    if value in grp_seq:
-                        cid[g][l][c][key].value = 1
-    # rename clone ids - get dictionaries step by step
-    first_key = []
-    for k1 in cid.keys():
-        first_key.append(k1)
-    first_key = list(set(first_key))
-    first_key_dict = dict(zip(first_key, range(1,len(first_key)+1)))
-    # and now for the middle key
-    for g in cid:
-        second_key = []
-        for k2 in cid[g].keys():
-            second_key.append(k2)
-        second_key = list(set(second_key))
-        second_key_dict = dict(zip(second_key, range(1,len(second_key)+1)))
-        for l in cid[g]:
-            # and now for the last key
-            third_key = []
-            for k3 in cid[g][l].keys():
-                third_key.append(k3)
-            third_key = list(set(third_key))
-            third_key_dict = dict(zip(third_key, range(1,len(third_key)+1)))
-            for key, value in dict(cid[g][l]).items():
-                vL = []
-                for v in value:
-                    if type(v) is int:
-                        break
-                    # instead of converting to another tree, i will just make it a dictionary
-                    clone_dict[v] = str(first_key_dict[g])+'_'+str(second_key_dict[l])+'_'+str(third_key_dict[key])
-    # add it to the original dataframes
-    dat_heavy[clone_key] = pd.Series(clone_dict)
-    hclone = dict(zip(dat_heavy['cell_id'], dat_heavy[clone_key]))
-    hlclone = dict(zip(dat['sequence_id'], [hclone[c] for c in dat['cell_id']]))
-    
-    dat[clone_key] = pd.Series(hlclone)
-    # repeat this process for the light chains within each clone, but only for those with more than 1 light chains in a clone
-    dat_light = dat[~(dat['locus'] == locus_)].copy()
-    if dat_light.shape[0] != 0:
-        # retrieve the J genes and J genes
-        for c in tqdm(list(set(dat_light[clone_key])), desc = 'Refining clone assignment based on light chain pairing '):
-            dat_light_c = dat_light[dat_light[clone_key] == c]
-            if dat_light_c.shape[0] > 1:
-                if not by_alleles:
-                    if 'v_call_genotyped' in dat_light_c.columns:
-                        Vlight = [re.sub('[*][0-9][0-9]', '', v) for v in dat_light_c['v_call_genotyped']]
-                    else:
-                        Vlight = [re.sub('[*][0-9][0-9]', '', v) for v in dat_light_c['v_call']]
-                    Jlight = [re.sub('[*][0-9][0-9]', '', j) for j in dat_light_c['j_call']]
-                else:
-                    if 'v_call_genotyped' in dat_light_c.columns:
-                        Vlight = [v for v in dat_light_c['v_call_genotyped']]
-                    else:
-                        Vlight = [v for v in dat_light_c['v_call']]
-                    Jlight = [j for j in dat_light_c['j_call']]
-                
-                # collapse the alleles to just genes
-                Vlight = [','.join(list(set(v.split(',')))) for v in Vlight]
-                Jlight = [','.join(list(set(j.split(',')))) for j in Jlight]
-                
-                seq = dict(zip(dat_light_c.index, dat_light_c[key_]))
-                
-                if recalculate_length:
-                    seq_length = [len(str(l)) for l in dat_light_c[key_]]
-                else:
-                    try:
-                        seq_length = [len(str(l)) for l in dat_light_c[key_+'_length']]
-                    except:
-                        raise ValueError("{} not found in {} input table.".format(key_ + '_length', locus_log2_dict[locus_]))
-                seq_length_dict = dict(zip(dat_light_c.index, seq_length))                
-
-                # Create a dictionary and group sequence ids with same V and J genes
-                V_Jlight = dict(zip(dat_light_c.index, zip(Vlight,Jlight)))
-                vj_lightgrp = defaultdict(list)
-                for key, val in sorted(V_Jlight.items()):
-                    vj_lightgrp[val].append(key)
-                # and now we split the groups based on lengths of the seqs
-                vj_len_lightgrp = Tree()
-                seq_lightgrp = Tree()
-                for g in vj_lightgrp:
-                    # first, obtain what's the unique lengths
-                    jlen = []
-                    for contig_id in vj_lightgrp[g]:
-                        jlen.append(seq_length_dict[contig_id])
-                    setjlen = list(set(jlen))
-                    # then for each unique length, we add the contigs to a new tree if it matches the length
-                    # and also the actual seq sequences into a another one
-                    for s in setjlen:
-                        for contig_id in vj_lightgrp[g]:
-                            jlen_ = seq_length_dict[contig_id]
-                            if jlen_ == s:
-                                vj_len_lightgrp[g][s][contig_id].value = 1
-                                seq_lightgrp[g][s][seq[contig_id]].value = 1
-                                for c in [contig_id]:
-                                    vj_len_lightgrp[g][s][c] = seq[c]
-
-                clones_light = Tree()
-                for g in seq_lightgrp:
-                    for l in seq_lightgrp[g]:
-                        seq_ = list(seq_lightgrp[g][l])
-                        tdarray = np.array(seq_).reshape(-1,1)
-                        d_mat = squareform(pdist(tdarray, lambda x,y: hamming(x[0],y[0])))
-                        tr = math.floor(int(l)*(1-identity))
-                        d_mat = np.tril(d_mat)
-                        np.fill_diagonal(d_mat, 0)
-                        indices_temp = []
-                        indices = []
-                        indices_temp = [list(x) for x in np.tril_indices_from(d_mat)]
-                        indices = list(zip(indices_temp[0], indices_temp[1]))
-                        if len(indices) > 1:
-                            for pairs in indices:
-                                if pairs[0] == pairs[1]:
-                                    indices.remove(pairs)
-                        indices_j = []
-                        for p in range(0, len(indices)):
-                            a1, b1 = indices[p]
-                            indices_j.append(seq_[a1])
-                            indices_j.append(seq_[b1])
-                        indices_j_f = list(set(indices_j))
-                        source, target = d_mat.nonzero()
-                        source_target = list(zip(source.tolist(), target.tolist()))
-                        if len(source) == 0 & len(target) == 0:
-                            source_target = list([(0,0)])
-                        dist = {}
-                        for st in source_target:
-                            dist.update({st:d_mat[st]})
-                        cm1 = []
-                        cm2 = []
-                        cm3 = []
-                        tr2 = min(dist.values())
-                        if tr2 <= tr:
-                            for d in dist:
-                                if dist[d] == tr2:
-                                    cm1.append(d)
-                                else:
-                                    cm3.append(d)
-                        else:
-                            for d in dist:
-                                cm3.append(d)
-
-                        if len(dist) > 3:
-                            for d in dist:
-                                if dist[d] < tr:
-                                    cm2.append(d)
-                                else:
-                                    cm3.append(d)
-                            cm2 = list(set(cm2) ^ set(cm1))
-                            cm3 = list(set(cm3) ^ set(cm1))
-                        j_list1 = []
-                        if len(cm1) > 0:
-                            for i in range(0, len(cm1)):
-                                a, b = cm1[i]
-                                j_list1.append(seq_[a])
-                                j_list1.append(seq_[b])
-                            j_list1 = list(set(j_list1))
-                        j_list2 = []
-                        if len(cm3) > 0:
-                            for i in range(0, len(cm2)):
-                                a, b = cm2[i]
-                                j_list2.append(seq_[a])
-                                j_list2.append(seq_[b])
-                            j_list2 = list(set(j_list2))
-                        j_list3 = []
-                        if len(cm3) > 0:
-                            for i in range(0, len(cm3)):
-                                a, b = cm3[i]
-                                j_list3.append(seq_[a])
-                                j_list3.append(seq_[b])
-                            j_list3 = list(set(j_list3))
-                        for jl3_1 in j_list1:
-                            if jl3_1 in j_list3:
-                                j_list3.remove(jl3_1)
-                        for jl2_1 in j_list1:
-                            if jl2_1 in j_list2:
-                                j_list2.remove(jl2_1)
-                        for jl3_2 in j_list2:
-                            if jl3_2 in j_list3:
-                                j_list3.remove(jl3_2)
-                        j_list3 = [i.split() for i in list(set(j_list3))]
-                        if len(j_list1) > 0:
-                            clones_light[g][l][str(0)] = j_list1
-                        if len(j_list2) > 0:
-                            clones_light[g][l][str(1)] = j_list2
-                        if len(j_list3) > 0:
-                            for c in range(0, len(j_list3)):
-                                clones_light[g][l][str(c+2)] = j_list3[c]
-                clone_dict_light = {}
-                cid_light = Tree()
-                for g in clones_light:
-                    for l in clones_light[g]:
-                        for c in clones_light[g][l]:
-                            grp_seq = clones_light[g][l][c]
-                            for key, value in vj_len_lightgrp[g][l].items():
-                                if value in grp_seq:
-                                    cid_light[g][l][c][key].value = 1
-                first_key = []
-                for k1 in cid_light.keys():
-                    first_key.append(k1)
-                first_key = list(set(first_key))
-                first_key_dict = dict(zip(first_key, range(1,len(first_key)+1)))
-                for g in cid_light:
-                    second_key = []
-                    for k2 in cid_light[g].keys():
-                        second_key.append(k2)
-                    second_key = list(set(second_key))
-                    second_key_dict = dict(zip(second_key, range(1,len(second_key)+1)))
-                    for l in cid_light[g]:
-                        third_key = []
-                        for k3 in cid_light[g][l].keys():
-                            third_key.append(k3)
-                        third_key = list(set(third_key))
-                        third_key_dict = dict(zip(third_key, range(1,len(third_key)+1)))
-                        for key, value in dict(cid_light[g][l]).items():
-                            vL = []
-                            for v in value:
-                                if type(v) is int:
-                                    break
-                                clone_dict_light[v] = str(first_key_dict[g])+'_'+str(second_key_dict[l])+'_'+str(third_key_dict[key])
-                lclones = list(clone_dict_light.values())
-                # will just update the main dat directly
-                if len(list(set(lclones))) > 1:
-                    lclones_dict = dict(zip(sorted(list(set(lclones))), [str(x) for x in range(1,len(list(set(lclones)))+1)]))
-                else:
-                    lclones_dict = dict(zip(sorted(list(set(lclones))), ['0' for x in list(set(lclones))]))
-                renamed_clone_dict_light = {}
-                for key, value in clone_dict_light.items():
-                    renamed_clone_dict_light[key] = lclones_dict[value]
-                dat.at[renamed_clone_dict_light.keys(), clone_key] = dat.loc[renamed_clone_dict_light.keys(), clone_key] + '_' + pd.Series(renamed_clone_dict_light)                
+    if incremental and clone_index is not None:
+        # the index is extended with the new assignments so that it stays in sync with the data
+        clone_index.update(dat.loc[dat_heavy.index[~assigned[dat_heavy.index]]], clone_key = clone_key, memo = memo)
 
     if os.path.isfile(str(self)):
         dat.to_csv("{}/{}_clone.tsv".format(os.path.dirname(self), os.path.basename(self).split('.tsv')[0]), sep = '\t', index = False)
@@ -508,6 +257,8 @@ def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = Fals
         deep=('Updated Dandelion object: \n'
         '   \'data\', contig-indexed clone table\n'
         '   \'metadata\', cell-indexed clone table\n'))
+    if isinstance(identity, (list, tuple, np.ndarray)):
+        clone_key = clone_keys
     if self.__class__ == Dandelion:
         if self.germline is not None:
             germline_ = self.germline
@@ -533,18 +284,606 @@ def find_clones(self, identity=0.85, key = None, locus = None, by_alleles = Fals
             threshold_ = self.threshold
         else:
             threshold_ = None
-        if ('clone_id' in self.data.columns) and (clone_key is not None):
+        if type(clone_key) is list:
+            self.__init__(data = dat, germline = germline_, distance = dist_, edges = edge_, layout = layout_, graph = graph_, initialize = True, retrieve = clone_key, split = False, collapse = True, combine = True)
+        elif ('clone_id' in self.data.columns) and (clone_key is not None):
             self.__init__(data = dat, germline = germline_, distance = dist_, edges = edge_, layout = layout_, graph = graph_, initialize = True, retrieve = clone_key, split = False, collapse = True, combine = True) # TODO: need to check the following bits if it works properly if only heavy chain tables are provided
         elif ('clone_id' not in self.data.columns) and (clone_key is not None):
             self.__init__(data = dat, germline = germline_, distance = dist_, edges = edge_, layout = layout_, graph = graph_, initialize = True, clone_key = clone_key, retrieve = clone_key, split = False, collapse = True, combine = True)
         else:
             self.__init__(data = dat, germline = germline_, distance = dist_, edges = edge_, layout = layout_, graph = graph_, initialize = True, clone_key = clone_key)
         self.threshold = threshold_
+        if store_distance:
+            if self.distance is None:
+                self.distance = Tree()
+            self.distance['junction'] = _junction_graph(pairs, dict(zip(dat_heavy.index, dat_heavy['cell_id'])), self.metadata.index)
     else:
-        out = Dandelion(data = dat, clone_key = clone_key, retrieve = clone_key, split = False, collapse = True, combine = True)
+        out = Dandelion(data = dat, clone_key = None if type(clone_key) is list else clone_key, retrieve = clone_key, split = False, collapse = True, combine = True)
+        if store_distance:
+            out.distance = Tree()
+            out.distance['junction'] = _junction_graph(pairs, dict(zip(dat_heavy.index, dat_heavy['cell_id'])), out.metadata.index)
         return(out)
 
 
+def _junction_graph(pairs, cells, index):
+    """
+    Builds the cell x cell sparse matrix of the junction pairs found by `find_clones`.
+
+    Parameters
+    ----------
+    pairs : list
+        list of (source contig ids, target contig ids, distances) per partition.
+    cells : dict
+        dictionary of {contig id : cell id}.
+    index : Index
+        cell ids of the matrix rows and columns.
+
+    Returns
+    -------
+    symmetric `csr_matrix` with the cell ids of its rows and columns in a `cell_ids` attribute. Cells with several heavy chain contigs keep the smallest distance, and identical junctions are kept as explicit zeros.
+    """
+    pos = pd.Series(np.arange(len(index)), index = index)
+    if len(pairs) > 0:
+        source, target, dist = [np.concatenate(x) for x in zip(*pairs)]
+    else:
+        source, target, dist = [], [], []
+    tab = pd.DataFrame({'i':pos.reindex([cells[x] for x in source]).values, 'j':pos.reindex([cells[x] for x in target]).values, 'dist':dist}).dropna()
+    tab = tab[tab['i'] != tab['j']]
+    tab[['i', 'j']] = np.sort(tab[['i', 'j']].values.astype(np.int64), axis = 1)
+    tab = tab.groupby(['i', 'j'], sort = False)['dist'].min().reset_index()
+    row = np.concatenate([tab['i'].values, tab['j'].values]).astype(np.int64)
+    col = np.concatenate([tab['j'].values, tab['i'].values]).astype(np.int64)
+    data = np.concatenate([tab['dist'].values, tab['dist'].values])
+    mat = coo_matrix((data, (row, col)), shape = (len(index), len(index))).tocsr()
+    mat.cell_ids = np.asarray(index)
+    return(mat)
+
+
+def _refine_light_chains(dat, dat_light, refine, clone_key, key_, identity, by_alleles, recalculate_length, light_locus, ncpu = None, backend = None, max_memory = None, linkage = None, memo = None):
+    """
+    Splits heavy chain clones by the V/J/length partitions and junctions of their light chains. Updates the clone ids in `dat` directly.
+
+    Parameters
+    ----------
+    dat : DataFrame
+        contig table.
+    dat_light : DataFrame
+        light chain contigs of `dat`.
+    refine : list
+        clones to refine.
+    clone_key : str
+        column name for clones.
+    key_ : str
+        column name used for clone clustering.
+    identity : float
+        Junction similarity parameter.
+    by_alleles : bool
+        Whether or not to keep the allelic calls.
+    recalculate_length : bool
+        Whether or not to re-calculate junction length.
+    light_locus : str
+        name of the light chain loci, for error messages.
+    ncpu, backend, max_memory, linkage
+        passed on to `_cluster_partitions`.
+    memo : dict, optional
+        memo of normalised gene calls.
+    """
+    # only clones with more than 1 light chain are refined
+    dat_light = dat_light[dat_light[clone_key].isin(refine)]
+    dat_light = dat_light[dat_light.groupby(clone_key)[clone_key].transform('size') > 1]
+    if dat_light.shape[0] == 0:
+        return
+    # retrieve the V genes and J genes
+    Vlight, Jlight = _gene_calls(dat_light, by_alleles, memo)
+    seq_length = _junction_lengths(dat_light, key_, recalculate_length, light_locus)
+    # split the light chains of all clones into V/J/length partitions in a single pass
+    light_grp = pd.DataFrame({'clone':dat_light[clone_key], 'v':Vlight, 'j':Jlight, 'length':seq_length, 'junction':dat_light[key_]}, index = dat_light.index)
+    partitions_light, members_light = {}, {}
+    for (c, v, j, l), grp in light_grp.groupby(['clone', 'v', 'j', 'length'], sort = False):
+        partitions_light[(c, (v, j), l)], members_light[(c, (v, j), l)] = _collapse_partition(dict(zip(grp.index, grp['junction'])))
+
+    # the light chain partitions of all clones are independent of each other
+    cid_light = Tree()
+    for (c, g, l), labels in _cluster_partitions(partitions_light, identity, ncpu = ncpu, backend = backend, max_memory = max_memory, linkage = linkage, desc = 'Refining clone assignment based on light chain pairing ').items():
+        contig_ids, inverse = members_light[(c, g, l)]
+        cid_light[c][g][l] = (contig_ids, labels[inverse], np.array(partitions_light[(c, g, l)], dtype = object)[inverse])
+
+    renamed_clone_dict_light = {}
+    for c in cid_light:
+        clone_dict_light = _number_clones(cid_light[c])
+        lclones = sorted(set(clone_dict_light.values()))
+        if len(lclones) > 1:
+            lclones_dict = dict(zip(lclones, [str(x) for x in range(1, len(lclones)+1)]))
+        else:
+            lclones_dict = dict(zip(lclones, ['0' for x in lclones]))
+        for key, value in clone_dict_light.items():
+            renamed_clone_dict_light[key] = lclones_dict[value]
+    # will just update the main dat directly, for all clones at once
+    renamed = pd.Series(renamed_clone_dict_light, dtype = object)
+    dat.loc[renamed.index, clone_key] = dat.loc[renamed.index, clone_key] + '_' + renamed
+
+
+def _pair_light_chains(dat, dat_heavy, locus_, key_, by_alleles, recalculate_length, memo = None):
+    """
+    Retrieves the light chain paired with each heavy chain contig for paired clone calling.
+
+    Cells with multiple light chains are paired with the light chain with the highest umi count. Heavy chains without a light chain get empty calls and junctions.
+
+    Returns
+    -------
+    tuple of dictionaries {heavy sequence_id : value} holding the light chain V calls, J calls, junctions and junction lengths.
+    """
+    dat_light = dat[~(dat['locus'] == locus_)]
+    count = 'umi_count' if 'umi_count' in dat_light.columns else 'duplicate_count'
+    if count in dat_light.columns:
+        dat_light = dat_light.assign(_count = pd.to_numeric(dat_light[count], errors = 'coerce')).sort_values('_count', ascending = False, kind = 'mergesort')
+    dat_light = dat_light.drop_duplicates('cell_id')
+    V, J = _gene_calls(dat_light, by_alleles, memo)
+    L = _junction_lengths(dat_light, key_, recalculate_length)
+    light = pd.DataFrame({'v':V, 'j':J, 'junction':[str(x) for x in dat_light[key_]], 'length':L}, index = dat_light['cell_id'])
+    light = light.reindex(dat_heavy['cell_id'])
+    light = light.fillna({'v':'', 'j':'', 'junction':'', 'length':0})
+    light.index = dat_heavy.index
+    return(dict(light['v']), dict(light['j']), dict(light['junction']), dict(light['length'].astype(int)))
+
+
+def _gene_calls(dat, by_alleles = False, memo = None):
+    """
+    Retrieves the V and J gene calls used for partitioning contigs.
+
+    Parameters
+    ----------
+    dat : DataFrame
+        contig table.
+    by_alleles : bool
+        Whether or not to keep the allelic calls. Default is False.
+    memo : dict, optional
+        memo of normalised gene calls, e.g. `Dandelion._gene_call_memo`.
+
+    Returns
+    -------
+    tuple of lists holding the V and J calls.
+    """
+    if 'v_call_genotyped' in dat.columns:
+        V = dat['v_call_genotyped']
+    else:
+        V = dat['v_call']
+    # collapse the alleles to just genes, once per distinct call
+    V = _normalise_gene_calls(V, keep_alleles = by_alleles, memo = memo)
+    J = _normalise_gene_calls(dat['j_call'], keep_alleles = by_alleles, memo = memo)
+    return(V, J)
+
+
+def _junction_lengths(dat, key, recalculate_length = True, locus = None):
+    """
+    Retrieves the junction lengths used for partitioning contigs.
+
+    Parameters
+    ----------
+    dat : DataFrame
+        contig table.
+    key : str
+        column name of the junctions.
+    recalculate_length : bool
+        Whether or not to re-calculate junction length, rather than rely on the parsed `key`_length column. Default is True.
+    locus : str, optional
+        name of the locus, used in the error message if the length column is missing.
+
+    Returns
+    -------
+    list of junction lengths (int).
+    """
+    if recalculate_length:
+        return([len(str(l)) for l in dat[key]])
+    if key + '_length' not in dat.columns:
+        raise ValueError("{} not found in {}input table.".format(key + '_length', '' if locus is None else locus + ' '))
+    return([int(l) for l in dat[key + '_length']])
+
+
+def _canonical_call(call):
+    """
+    Sorts multiple gene calls, as the order in which they are collapsed is not stable between sessions.
+    """
+    return(','.join(sorted(str(call).split(','))))
+
+
+def _collapse_partition(contigs):
+    """
+    Reduces a partition of {sequence_id : junction} to its unique junctions.
+
+    Returns
+    -------
+    list of unique junctions, and a tuple of the sequence ids and the index of each of their junctions in the unique list.
+    """
+    junctions, inverse, _ = _collapse_junctions(list(contigs.values()))
+    return(list(junctions), (list(contigs.keys()), inverse))
+
+
+def _number_clones(cid, hash_ids = False):
+    """
+    Formats the clone numbers of each V/J group and junction length into clone ids.
+
+    Parameters
+    ----------
+    cid : Tree
+        Tree of {(V, J) : {length : (list of sequence ids, array of clone numbers, array of junctions)}}.
+    hash_ids : bool
+        Whether or not to name the clones with `_hash_clone` rather than by their position. Default is False.
+
+    Returns
+    -------
+    dictionary of {sequence_id : clone id}.
+    """
+    clone_dict = {}
+    if hash_ids:
+        for g in cid:
+            for l in cid[g]:
+                contig_ids, labels, junctions = cid[g][l]
+                # each clone is represented by its smallest junction
+                rep = pd.Series(junctions, dtype = object).groupby(labels).transform('min')
+                clone_dict.update(zip(contig_ids, [_hash_clone(g, l, r) for r in rep]))
+        return(clone_dict)
+    # keys are sorted so that the numbering does not depend on the order in which partitions were processed
+    first_key_dict = dict(zip(sorted(cid), range(1, len(cid)+1)))
+    for g in cid:
+        second_key_dict = dict(zip(sorted(cid[g]), range(1, len(cid[g])+1)))
+        for l in cid[g]:
+            contig_ids, labels = cid[g][l][:2]
+            # the last key is the rank of the clone number within the partition
+            third_key = np.unique(labels, return_inverse = True)[1] + 1
+            prefix = str(first_key_dict[g])+'_'+str(second_key_dict[l])+'_'
+            clone_dict.update(zip(contig_ids, [prefix + str(k) for k in third_key]))
+    return(clone_dict)
+
+
+def _hash_clone(g, l, junction):
+    """
+    Clone id from the V/J genes and length of a partition and a representative junction.
+    """
+    content = '|'.join([_canonical_call(x) for x in g] + [str(int(x)) for x in np.atleast_1d(l)] + [str(junction)])
+    return(hashlib.blake2b(content.encode('utf-8'), digest_size = 8).hexdigest())
+
+
+def _cluster_partitions(partitions, identity, ncpu = None, backend = None, max_memory = None, linkage = None, indel = 0, desc = None, return_pairs = False):
+    """
+    Groups the junctions of independent partitions into clones, optionally with a pool of workers.
+
+    Parameters
+    ----------
+    partitions : dict
+        dictionary of {partition key : list of unique sequences}. The last element of each key is the junction length.
+    identity : float
+        Junction similarity parameter.
+    ncpu : int, optional
+        number of workers. None defaults to 1 (no parallelization).
+    backend : str, optional
+        `joblib` backend. None defaults to 'loky'.
+    max_memory : int, optional
+        memory budget in bytes for comparing the junctions of a partition.
+    linkage : str, optional
+        None for the default grouping or 'single' for single linkage clustering.
+    indel : int
+        maximum junction length difference within a partition. Partitions keyed with a length of None hold junctions of different lengths.
+    desc : str, optional
+        description for the progress bar.
+    return_pairs : bool
+        Whether or not to also return the pairs of unique sequences within the threshold of each partition.
+
+    Returns
+    -------
+    dictionary of {partition key : array of clone numbers of the unique sequences} in the same order as `partitions`. If `return_pairs` is True, the values are tuples of the clone numbers and the pairs.
+    """
+    results = {}
+    # single sequence partitions are trivial and not worth sending to a worker
+    # the rest are scheduled largest first so that big partitions do not end up as stragglers
+    todo = sorted([k for k in partitions if len(partitions[k]) > 1], key = lambda k: len(partitions[k]), reverse = True)
+    for k in partitions:
+        if len(partitions[k]) == 1:
+            results[k] = _group_junctions(partitions[k], k[-1], identity, indel = indel, return_pairs = return_pairs)
+    if ncpu is None or int(ncpu) == 1:
+        for k in tqdm(todo, desc = desc):
+            results[k] = _group_junctions(partitions[k], k[-1], identity, max_memory, linkage, indel, return_pairs)
+    else:
+        if backend is None:
+            backend = 'loky'
+        res = Parallel(n_jobs = int(ncpu), backend = backend)(delayed(_group_junctions)(partitions[k], k[-1], identity, max_memory, linkage, indel, return_pairs) for k in tqdm(todo, desc = desc + 'parallelizing with ' + str(ncpu) + ' cpus '))
+        results.update(dict(zip(todo, res)))
+    # results are returned in the input order regardless of which worker finished first
+    return({k:results[k] for k in partitions})
+
+
+def _group_junctions(seqs, length, identity, max_memory = None, linkage = None, indel = 0, return_pairs = False):
+    """
+    Groups unique junction sequences of the same V/J/length partition into clones.
+
+    Parameters
+    ----------
+    seqs : list
+        unique junction sequences in the partition, in sorted order.
+    length : int, tuple
+        junction length of the partition, or the heavy and light chain junction lengths in paired mode.
+    identity : float, list
+        Junction similarity parameter. A list of values returns the single linkage clones at every value.
+    max_memory : int, optional
+        memory budget in bytes for the pairwise comparison. None defaults to `CHUNK_MEMORY`.
+    linkage : str, optional
+        None for the default grouping or 'single' for single linkage clustering.
+    indel : int
+        if above 0, `seqs` can have different lengths and are clustered with `_group_junctions_indel`.
+    return_pairs : bool
+        Whether or not to also return the pairs of sequences within the threshold.
+
+    Returns
+    -------
+    numpy ndarray of clone numbers, one per sequence, or one row per identity value. If `return_pairs` is True, a tuple of the clone numbers and the source, target and distance arrays of the pairs within the threshold.
+    """
+    n = len(seqs)
+    if indel:
+        return(_group_junctions_indel(seqs, identity, indel, max_memory, return_pairs))
+    if isinstance(length, tuple):
+        # paired mode, the threshold is set on the combined heavy and light chain junction length
+        length = sum(length)
+    if isinstance(identity, (list, tuple, np.ndarray)):
+        # threshold sweep, the pairs within the loosest threshold are linked in order of distance and the clones are read off at every threshold
+        trs = [math.floor(int(length)*(1-i)) for i in identity]
+        if n == 1:
+            return(_with_pairs(np.zeros((len(trs), 1), dtype = int), return_pairs))
+        source, target, dist = _neighbour_pairs(_encode_junctions(seqs), max(trs), max_memory = max_memory)
+        return(_with_pairs(_union_find(n, source, target, dist = dist, cuts = trs), return_pairs, source, target, dist))
+    # acceptable threshold for this length of sequence
+    tr = math.floor(int(length)*(1-identity))
+    if n == 1:
+        return(_with_pairs(np.zeros(1, dtype = int), return_pairs))
+    # only pairs within the threshold are needed; large partitions are searched with an index rather than all-vs-all
+    source, target, dist = _neighbour_pairs(_encode_junctions(seqs), tr, max_memory = max_memory)
+    if linkage == 'single':
+        # every pair within the threshold links two junctions into the same clone
+        return(_with_pairs(_union_find(n, source, target), return_pairs, source, target, dist))
+
+    labels = np.full(n, -1, dtype = int)
+    # sequences that are separated by the minimum distance, if it is within the threshold, form the first clone.
+    # e.g. in a 3x3 distance matrix where the acceptable distance threshold is 2, if SeqA is 1 different from SeqB and SeqB is 2 different from SeqC,
+    # SeqA and SeqB are grouped together while SeqC is more different than SeqA and SeqB and is therefore grouped separately.
+    if len(dist) > 0:
+        tr2 = dist.min()
+        labels[np.concatenate([source[dist == tr2], target[dist == tr2]])] = 0
+        # with more than 3 pairs, the remaining pairs below the threshold form a second clone
+        if n * (n - 1) // 2 > 3:
+            pairs = (dist > tr2) & (dist < tr)
+            idx = np.concatenate([source[pairs], target[pairs]])
+            labels[idx[labels[idx] < 0]] = 1
+    # everything else is split into individual clones
+    # the +2 here is so that the numbers come up after 1. It doesn't matter because the clone ID numbers are reformatted later
+    singles = np.flatnonzero(labels < 0)
+    labels[singles] = np.arange(2, len(singles)+2)
+    return(_with_pairs(labels, return_pairs, source, target, dist))
+
+
+def _with_pairs(labels, return_pairs, source = None, target = None, dist = None):
+    """
+    Attaches the pairs within the threshold to the clone numbers of a partition if requested.
+    """
+    if not return_pairs:
+        return(labels)
+    if source is None:
+        source, target, dist = np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    return(labels, (source, target, dist))
+
+
+def _group_junctions_indel(seqs, identity, indel, max_memory = None, return_pairs = False):
+    """
+    Groups unique junction sequences of a V/J group, across junction lengths, into clones with single linkage.
+
+    Junctions of the same length are compared by hamming distance. Junctions whose lengths differ by up to `indel` are compared with a banded edit distance,
+    with the threshold of the longer junction.
+
+    Returns
+    -------
+    numpy ndarray of clone numbers, one per sequence.
+    """
+    seqs = [str(x) for x in seqs]
+    n = len(seqs)
+    if n == 1:
+        return(_with_pairs(np.zeros(1, dtype = int), return_pairs))
+    lengths = np.array([len(x) for x in seqs])
+    blocks = {l:np.flatnonzero(lengths == l) for l in np.unique(lengths)}
+    encoded = {l:_encode_junctions([seqs[i] for i in idx]) for l, idx in blocks.items()}
+    source, target, dist = [], [], []
+    for l, idx in blocks.items():
+        s, t, d = _neighbour_pairs(encoded[l], math.floor(int(l)*(1-identity)), max_memory = max_memory)
+        source.append(idx[s])
+        target.append(idx[t])
+        dist.append(d)
+        for l2, idx2 in blocks.items():
+            tr = math.floor(int(l2)*(1-identity))
+            # the length difference alone costs l2 - l edits
+            if l < l2 <= l + indel and l2 - l <= tr:
+                s, t, d = _indel_pairs(encoded[l], encoded[l2], tr, max_memory = max_memory)
+                source.append(idx[s])
+                target.append(idx2[t])
+                dist.append(d)
+    source, target, dist = np.concatenate(source), np.concatenate(target), np.concatenate(dist)
+    return(_with_pairs(_union_find(n, source, target), return_pairs, source, target, dist))
+
+
+def _parse_clone_id(clone):
+    """
+    Splits a clone id generated by `find_clones` into its V/J, length and clone numbers.
+    """
+    try:
+        return(tuple(int(x) for x in str(clone).split('_')[:3]))
+    except ValueError:
+        raise ValueError("Unable to extend clone id {}. Incremental mode requires clone ids generated by find_clones.".format(clone))
+
+
+def _nearest_junctions(new_seqs, old_seqs, length, identity, max_memory = None):
+    """
+    For each new sequence, returns the index of the closest existing sequence within the threshold, or -1 if there is none.
+    """
+    tr = math.floor(int(length)*(1-identity))
+    if isinstance(old_seqs, np.ndarray) and old_seqs.dtype == np.uint8:
+        # already encoded, e.g. from a CloneIndex
+        old_enc = np.asarray(old_seqs)
+        width = max([old_enc.shape[1]] + [len(str(x)) for x in new_seqs])
+        if width > old_enc.shape[1]:
+            old_enc = np.pad(old_enc, ((0, 0), (0, width - old_enc.shape[1])))
+    else:
+        width = max([len(str(x)) for x in list(new_seqs) + list(old_seqs)])
+        old_enc = _encode_junctions(old_seqs, width)
+    nearest, dist = _nearest_rows(_encode_junctions(new_seqs, width), old_enc, max_memory = max_memory)
+    return(np.where(dist <= tr, nearest, -1))
+
+
+def _extend_clones(vj_len_grp, existing, identity, clone_index = None, linkage = None, hash_ids = False, max_memory = None):
+    """
+    Assigns contigs without a clone id to the existing clones of their V/J/length partition, or to new clones.
+
+    Parameters
+    ----------
+    vj_len_grp : Tree
+        Tree of {(V, J) : {length : {sequence_id : junction}}}.
+    existing : dict
+        dictionary of {sequence_id : clone id} for contigs that were already assigned.
+    identity : float
+        Junction similarity parameter.
+    clone_index : CloneIndex, optional
+        if provided, the existing members of each partition are retrieved from the index rather than from `vj_len_grp`.
+    linkage : str, optional
+        None for the default grouping or 'single' for single linkage clustering of the unmatched junctions.
+    hash_ids : bool
+        Whether or not new clones are named with `_hash_clone` rather than numbered after the existing clones.
+    max_memory : int, optional
+        memory budget in bytes for comparing the new junctions of a partition with the existing ones and with each other.
+
+    Returns
+    -------
+    dictionary of {sequence_id : clone id} for all contigs. Existing clone ids are unchanged.
+    """
+    clone_dict = dict(existing)
+    # work out the current numbering of each V/J group and partition. Hashed clone ids need no numbering
+    first_key_dict, second_key_dict = {}, {}
+    max_first, max_second, max_third = 0, defaultdict(int), defaultdict(int)
+    if not hash_ids:
+        for clone in set(existing.values()):
+            k1, k2, k3 = _parse_clone_id(clone)
+            max_first = max(max_first, k1)
+            max_second[k1] = max(max_second[k1], k2)
+            max_third[(k1, k2)] = max(max_third[(k1, k2)], k3)
+        # partitions are keyed on the sorted gene calls as multiple calls are not stored in a stable order
+        if clone_index is not None:
+            p = clone_index.partitions
+            for v, j, l, st in zip(p['v_call'], p['j_call'], p['junction_length'], p['start']):
+                k1, k2, _ = _parse_clone_id(clone_index.clones[st])
+                first_key_dict[(v, j)] = k1
+                second_key_dict[(v, j, int(l))] = k2
+        else:
+            for g in vj_len_grp:
+                for l in vj_len_grp[g]:
+                    for key in vj_len_grp[g][l]:
+                        if key in existing:
+                            k1, k2, _ = _parse_clone_id(existing[key])
+                            first_key_dict[(_canonical_call(g[0]), _canonical_call(g[1]))] = k1
+                            second_key_dict[(_canonical_call(g[0]), _canonical_call(g[1]), int(l))] = k2
+                            break
+
+    for g in sorted(vj_len_grp):
+        gc = (_canonical_call(g[0]), _canonical_call(g[1]))
+        for l in sorted(vj_len_grp[g]):
+            contigs = vj_len_grp[g][l]
+            new_contigs = [key for key in contigs if key not in existing]
+            if len(new_contigs) == 0:
+                continue
+            new_seqs = sorted(set([contigs[key] for key in new_contigs]))
+            seq_clone = {}
+            if clone_index is not None:
+                old_enc, old_clones, _ = clone_index.lookup(g[0], g[1], l)
+                if len(old_clones) > 0:
+                    nearest = _nearest_junctions(new_seqs, old_enc, l, identity, max_memory)
+                    for s, n in zip(new_seqs, nearest):
+                        if n > -1:
+                            seq_clone[s] = str(old_clones[n])
+            else:
+                old = {}
+                for key in contigs:
+                    if key in existing:
+                        old.setdefault(contigs[key], existing[key])
+                if len(old) > 0:
+                    old_seqs = sorted(old)
+                    nearest = _nearest_junctions(new_seqs, old_seqs, l, identity, max_memory)
+                    for s, n in zip(new_seqs, nearest):
+                        if n > -1:
+                            seq_clone[s] = old[old_seqs[n]]
+            # whatever is left forms new clones in this partition
+            unmatched = [s for s in new_seqs if s not in seq_clone]
+            if len(unmatched) > 0 and hash_ids:
+                grouped = _group_junctions(unmatched, l, identity, max_memory, linkage)
+                rep = pd.Series(unmatched, dtype = object).groupby(grouped).transform('min')
+                seq_clone.update(zip(unmatched, [_hash_clone(g, l, r) for r in rep]))
+            elif len(unmatched) > 0:
+                if gc not in first_key_dict:
+                    max_first += 1
+                    first_key_dict[gc] = max_first
+                k1 = first_key_dict[gc]
+                if gc + (int(l),) not in second_key_dict:
+                    max_second[k1] += 1
+                    second_key_dict[gc + (int(l),)] = max_second[k1]
+                k2 = second_key_dict[gc + (int(l),)]
+                grouped = np.unique(_group_junctions(unmatched, l, identity, max_memory, linkage), return_inverse = True)[1]
+                for s, c in zip(unmatched, grouped):
+                    seq_clone[s] = str(k1)+'_'+str(k2)+'_'+str(max_third[(k1, k2)] + c + 1)
+                max_third[(k1, k2)] += int(grouped.max()) + 1
+            for key in new_contigs:
+                clone_dict[key] = seq_clone[contigs[key]]
+    return(clone_dict)
+
+
+def _extend_light_clones(dat, dat_light, assigned, clones, hclone, key, clone_key, identity, by_alleles, recalculate_length, linkage = None, memo = None, max_memory = None):
+    """
+    Assigns the new light chains of existing clones to the light chain groups of those clones, or to new groups.
+    Updates the clone ids of the new light chain contigs in `dat` directly.
+    """
+    if len(clones) == 0:
+        return
+    dat_light = dat_light[dat_light['cell_id'].map(hclone).isin(clones)]
+    V, J = _gene_calls(dat_light, by_alleles, memo)
+    L = _junction_lengths(dat_light, key, recalculate_length)
+    partition = dict(zip(dat_light.index, zip(dat_light['cell_id'].map(hclone), V, J, L)))
+
+    old_grp, new_grp = defaultdict(dict), defaultdict(list)
+    max_suffix = defaultdict(int)
+    for contig, p in partition.items():
+        c = p[0]
+        if assigned[contig]:
+            clone = dat.loc[contig, clone_key]
+            old_grp[p].setdefault(dat.loc[contig, key], clone)
+            if clone != c:
+                try:
+                    max_suffix[c] = max(max_suffix[c], int(str(clone)[len(c)+1:]))
+                except ValueError:
+                    pass
+        else:
+            new_grp[p].append(contig)
+
+    for p in sorted(new_grp):
+        c, l = p[0], p[-1]
+        seqs = sorted(set([dat.loc[contig, key] for contig in new_grp[p]]))
+        seq_clone = {}
+        if len(old_grp[p]) > 0:
+            old_seqs = sorted(old_grp[p])
+            nearest = _nearest_junctions(seqs, old_seqs, l, identity, max_memory)
+            for s, n in zip(seqs, nearest):
+                if n > -1:
+                    seq_clone[s] = old_grp[p][old_seqs[n]]
+        unmatched = [s for s in seqs if s not in seq_clone]
+        if len(unmatched) > 0:
+            grouped = np.unique(_group_junctions(unmatched, l, identity, max_memory, linkage), return_inverse = True)[1]
+            for s, g in zip(unmatched, grouped):
+                seq_clone[s] = c + '_' + str(max_suffix[c] + g + 1)
+            max_suffix[c] += int(grouped.max()) + 1
+        for contig in new_grp[p]:
+            dat.at[contig, clone_key] = seq_clone[dat.loc[contig, key]]
+
+
 def transfer(self, dandelion, expanded_only=False, neighbors_key = None, rna_key = None, bcr_key = None, overwrite = None):
     """
     Transfer data in `Dandelion` slots to `AnnData` object, updating the `.obs`, `.uns`, `.obsm` and `.obsp`slots.
@@ -675,7 +1014,7 @@ def transfer(self, dandelion, expanded_only=False, neighbors_key = None, rna_key
 
 def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len', doublets='drop', fileformat='airr', ncpu = None, dirs = None, outFilePrefix = None, key_added = None, verbose = False):
     """
-    Find clones using changeo's `DefineClones.py <https://changeo.readthedocs.io/en/stable/tools/DefineClones.html>`__.
+    Find clones using changeo's `DefineClones.py <https://changeo.readthedocs.io/en/stable/tools/DefineClones.html>`__ clustering, run in-process on the data.
 
     Parameters
     ----------
@@ -696,11 +1035,11 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
     ncpu : int, optional
         number of cpus for parallelization. Default is all available cpus.
     dirs : str, optional
-        If specified, out file will be in this location.
+        If specified, the heavy chain clone table will be written to this location. It is always written next to the input file if a file path is provided.
     outFilePrefix : str, optional
         If specified, the out file name will have this prefix. None defaults to 'dandelion_define_clones'
     verbose : bool
-        Whether or not to print the command used in terminal to call DefineClones.py. Default is False.
+        Whether or not to print the DefineClones.py settings used. Default is False.
     
     Returns
     -------
@@ -727,35 +1066,17 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
     dat_l = dat[dat['locus'].isin(['IGK', 'IGL'])]
 
     if os.path.isfile(str(self)):
-        tmpFolder = "{}/tmp".format(os.path.dirname(self))
-        outFolder = "{}".format(os.path.dirname(self))
-    else:
-        import tempfile
-        tmpFolder = "{}/tmp".format(tempfile.TemporaryDirectory().name)
-        outFolder = "{}".format(tempfile.TemporaryDirectory().name)
-
-    if not os.path.exists(tmpFolder):
-        os.makedirs(tmpFolder)
-    if not os.path.exists(outFolder):
-        os.makedirs(outFolder)
-
-    if os.path.isfile(str(self)):
-        h_file1 = "{}/{}_heavy-clone.tsv".format(tmpFolder, os.path.basename(self).split('.tsv')[0])
-        h_file2 = "{}/{}_heavy-clone.tsv".format(outFolder, os.path.basename(self).split('.tsv')[0])
-        l_file = "{}/{}_light.tsv".format(tmpFolder, os.path.basename(self).split('.tsv')[0])
-        outfile = "{}/{}_clone.tsv".format(outFolder, os.path.basename(self).split('.tsv')[0])
-    else:
+        outfile = "{}/{}_clone.tsv".format(os.path.dirname(self), os.path.basename(self).split('.tsv')[0])
+    elif dirs is not None:
         if outFilePrefix is not None:
             out_FilePrefix = outFilePrefix
         else:
             out_FilePrefix = 'dandelion_define_clones'
-        h_file1 = "{}/{}_heavy-clone.tsv".format(tmpFolder, out_FilePrefix)
-        h_file2 = "{}/{}_heavy-clone.tsv".format(outFolder, out_FilePrefix)
-        l_file = "{}/{}_light.tsv".format(tmpFolder, out_FilePrefix)
-        outfile = "{}/{}_clone.tsv".format(outFolder, out_FilePrefix)
-
-    dat_h.to_csv(h_file1, sep = '\t', index = False)
-    dat_l.to_csv(l_file, sep = '\t', index = False)
+        if not os.path.exists(dirs):
+            os.makedirs(dirs)
+        outfile = "{}/{}_clone.tsv".format(dirs, out_FilePrefix)
+    else:
+        outfile = None
 
     if 'v_call_genotyped' in dat.columns:
         v_field = 'v_call_genotyped'
@@ -773,16 +1094,6 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
     else:
         dist_ = dist
 
-    cmd = ['DefineClones.py',
-            '-d', h_file1,
-            '-o', h_file2,
-            '--act', action,
-            '--model', model,
-            '--norm', norm,
-            '--dist', str(dist_),
-            '--nproc', str(nproc),
-            '--vf', v_field]
-
     def clusterLinkage(cell_series, group_series):
         """
         Returns a dictionary of {cell_id : cluster_id} that identifies clusters of cells by analyzing their shared
@@ -796,46 +1107,28 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
         dict:  dictionary of {cell_id : cluster_id}.
         """
 
-        # assign initial clusters
-        # initial_dict = {cluster1: [cell1], cluster2: [cell1]}
-        initial_dict = {}
-        for cell, group in zip(cell_series, group_series):
-            try:
-                initial_dict[group].append(cell)
-            except KeyError:
-                initial_dict[group] = [cell]
-
-        # naive single linkage clustering (ON^2 best case, ON^3 worst case) ...ie for cells with multiple light chains
-        # cluster_dict = {cluster1: [cell1, cell2]}, 2 cells belong in same group if they share 1 light chain
-        while True:
-            cluster_dict = {}
-            for i, group in enumerate(initial_dict.keys()):
-                cluster_dict[i] = initial_dict[group]
-                for cluster in cluster_dict:
-                    # if initial_dict[group] and cluster_dict[cluster] share common cells, add initial_dict[group] to cluster
-                    if cluster != i and any(cell in initial_dict[group] for cell in cluster_dict[cluster]):
-                        cluster_dict[cluster] = cluster_dict[cluster] + initial_dict[group]
-                        del cluster_dict[i]
-                        break
-            # break if clusters stop changing, otherwise restart
-            if len(cluster_dict.keys()) == len(initial_dict.keys()):
-                break
-            else:
-                initial_dict = cluster_dict.copy()
+        # groups are numbered in order of appearance and every group of a cell is linked to the cell's first group
+        # single linkage then amounts to the connected components of the groups, i.e. 2 cells belong in same cluster if they share 1 light chain group
+        cells, _ = pd.factorize(pd.Series(list(cell_series)))
+        groups, _ = pd.factorize(pd.Series(list(group_series)).astype(str))
+        first = pd.Series(groups).groupby(cells).transform('first').values
+        roots = _union_find(groups.max() + 1 if len(groups) > 0 else 0, groups, first)
+        # clusters are numbered 0, 1, 2... in order of their first group
+        _, cluster = np.unique(roots, return_inverse = True)
 
-        # invert cluster_dict for return
-        assign_dict = {cell:k for k,v in cluster_dict.items() for cell in set(v)}
+        # invert for return
+        assign_dict = dict(zip(cell_series, cluster.ravel()[first].tolist()))
 
         return assign_dict
 
-    def _lightCluster(heavy_file, light_file, out_file, doublets, fileformat):
+    def _lightCluster(heavy_df, light_df, out_file, doublets, fileformat):
         """
         Split heavy chain clones based on light chains
 
         Arguments:
-        heavy_file (str): heavy chain input file.
-        light_file (str): light chain input file.
-        out_file (str): heavy chain output file.
+        heavy_df (DataFrame): heavy chains with clone ids.
+        light_df (DataFrame): light chains.
+        out_file (str): heavy chain output file. Not written if None.
         doublets (str): method for handling multiple heavy chains per cell. one of 'drop' or 'count'.
         format (str): file format. one of 'changeo' or 'airr'.
         """
@@ -857,10 +1150,6 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
         else:
             sys.exit("Invalid format %s" % fileformat)
 
-        # read in heavy and light DFs
-        heavy_df = pd.read_csv(heavy_file, dtype='object', na_values=['', 'None', 'NA'], sep='\t')
-        light_df = pd.read_csv(light_file, dtype='object', na_values=['', 'None', 'NA'], sep='\t')
-
         # column checking
         expected_heavy_columns = [cell_id, clone_id, v_call, j_call, junction_length, umi_count]
         if set(expected_heavy_columns).issubset(heavy_df.columns) is False:
@@ -883,30 +1172,36 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
             heavy_df = heavy_df.groupby(cell_id, sort=False).apply(lambda x: x.nlargest(1, umi_count))
 
         # transfer clone IDs from heavy chain df to light chain df
-        clone_dict = {v[cell_id]:v[clone_id] for k, v in heavy_df[[clone_id, cell_id]].T.to_dict().items()}
-        light_df = light_df.loc[light_df[cell_id].apply(lambda x: x in clone_dict.keys()), ]
-        light_df[clone_id] = light_df.apply(lambda row: clone_dict[row[cell_id]], axis = 1)
+        clone_dict = dict(zip(heavy_df[cell_id], heavy_df[clone_id]))
+        light_df = light_df[light_df[cell_id].isin(clone_dict)].copy()
+        light_df[clone_id] = light_df[cell_id].astype('category').map(clone_dict).astype(object)
 
         # generate a "cluster_dict" of CELL:CLONE dictionary from light df  (TODO: use receptor object V/J gene names)
-        cluster_dict = clusterLinkage(light_df[cell_id],
-                                    light_df.apply(lambda row:
-                                                    getGene(row[v_call]) + ',' + \
-                                                    getGene(row[j_call]) + ',' + \
-                                                    str(row[junction_length]) + ',' + row[clone_id], axis=1))
+        # each distinct gene call is only parsed once
+        memo = getattr(self, '_gene_call_memo', None) if self.__class__ == Dandelion else None
+        v_gene = pd.Series(_map_categories(light_df[v_call], getGene, memo = memo, key = 'getGene'), index = light_df.index)
+        j_gene = pd.Series(_map_categories(light_df[j_call], getGene, memo = memo, key = 'getGene'), index = light_df.index)
+        cluster_dict = clusterLinkage(light_df[cell_id], v_gene.str.cat([j_gene, light_df[junction_length].astype(str), light_df[clone_id]], sep = ','))
 
         # add assignments to heavy_df
-        heavy_df = heavy_df.loc[heavy_df[cell_id].apply(lambda x: x in cluster_dict.keys()), :]
-        heavy_df[clone_id] = heavy_df[clone_id] + '_' + heavy_df.apply(lambda row: str(cluster_dict[row[cell_id]]), axis=1)
+        heavy_df = heavy_df[heavy_df[cell_id].isin(cluster_dict)].copy()
+        heavy_df[clone_id] = heavy_df[clone_id].str.cat(heavy_df[cell_id].astype('category').map(cluster_dict).astype(str), sep = '_')
 
         # write heavy chains
-        heavy_df.to_csv(out_file, sep='\t', index=False)
+        if out_file is not None:
+            heavy_df.to_csv(out_file, sep='\t', index=False)
         return(heavy_df, light_df)
 
     if verbose:
-        print('Running command: %s\n' % (' '.join(cmd)))
-    run(cmd)
+        print('Defining clones with act = %s, model = %s, norm = %s, dist = %s, vf = %s\n' % (action, model, norm, str(dist_), v_field))
+    # the heavy chains are clustered in-process, equivalent to DefineClones.py
+    memo = getattr(self, '_gene_call_memo', None) if self.__class__ == Dandelion else None
+    clones = _changeo_clones(dat_h, v_field = v_field, action = action, model = model, norm = norm, distance = dist_, ncpu = nproc, memo = memo)
+    # contigs that failed clustering are left out, as in the DefineClones.py output
+    dat_h = dat_h.loc[clones.index]
+    dat_h['clone_id'] = clones
 
-    h_df, l_df = _lightCluster(h_file2, l_file, outfile, doublets=doublets, fileformat=fileformat)
+    h_df, l_df = _lightCluster(dat_h, dat_l.copy(), outfile, doublets=doublets, fileformat=fileformat)
 
     h_df = load_data(h_df)
     # create a dictionary for cell_id : clone_id from h_df
@@ -917,14 +1212,9 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
     clone_ref = [c.split('_')[1] if c is not np.nan else c for c in clone_ref]
     l_df = load_data(l_df)
 
-    for x in l_df.index:
-        if l_df.loc[x, 'clone_id'] in clone_ref:
-            l_df.at[x, 'clone_id'] = linked_clones[l_df.loc[x, 'cell_id']]
-        else:
-            try:
-                l_df.at[x, 'clone_id'] = l_df.loc[x, 'cell_id']+'_notlinked'
-            except:
-                pass
+    # light chains are relinked to their cell's heavy chain clone or flagged as not linked
+    notlinked = (l_df['cell_id'] + '_notlinked').fillna(l_df['clone_id'])
+    l_df['clone_id'] = l_df['cell_id'].astype('category').map(linked_clones).astype(object).where(l_df['clone_id'].isin(clone_ref), notlinked)
 
     cloned_ = pd.concat([h_df, l_df])
     # transfer the new clone_id to the heavy + light file
@@ -965,7 +1255,7 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
         self.threshold = threshold_
     else:
         if ('clone_id' in dat.columns) and (clone_key is not None):
-            out = Dandelion(data = dat, retrieve = clonekey, split = False)
+            out = Dandelion(data = dat, retrieve = clone_key, split = False)
         elif ('clone_id' not in dat.columns) and (clone_key is not None):
             out = Dandelion(data = dat, clone_key = clone_key)
         else:
@@ -976,6 +1266,140 @@ def define_clones(self, dist = None, action = 'set', model = 'ham', norm = 'len'
         '   \'data\', contig-indexed clone table\n'
         '   \'metadata\', cell-indexed clone table\n'))
 
+
+def _changeo_clones(dat, v_field = 'v_call', j_field = 'j_call', seq_field = 'junction', action = 'set', model = 'ham', norm = 'len', distance = 0.0, sym = 'avg', linkage = 'single', ncpu = None, memo = None):
+    """
+    Assigns clones to heavy chain contigs with the same grouping and clustering as changeo's `DefineClones.py`, without writing or reading any files.
+
+    Parameters
+    ----------
+    dat : DataFrame
+        heavy chain contigs.
+    v_field, j_field, seq_field : str
+        columns holding the V calls, J calls and the sequences to compare.
+    action : str
+        'first' or 'set', how multiple gene calls are handled when grouping.
+    model : str
+        substitution model in `changeo.Distance.distance_models`.
+    norm : str
+        'len', 'mut' or 'none', how the distances are normalised.
+    distance : float
+        distance threshold for clonal grouping.
+    sym : str
+        'avg' or 'min', how asymmetric distances are combined.
+    linkage : str
+        'single', 'average' or 'complete' hierarchical clustering.
+    ncpu : int, optional
+        number of workers for clustering the groups. None defaults to 1 (no parallelization).
+    memo : dict, optional
+        gene call memo, e.g. `Dandelion._gene_call_memo`.
+
+    Returns
+    -------
+    pandas Series of clone ids, in the order the contigs are written by `DefineClones.py`. Contigs that fail grouping or clustering are not included.
+    """
+    if model not in ['ham', 'aa', 'hh_s1f', 'hh_s5f', 'mk_rs1nf', 'mk_rs5nf', 'hs1f_compat', 'm1n_compat']:
+        raise ValueError('Unrecognized distance model: {}.'.format(model))
+    seqs = ['' if pd.isnull(x) or x in ['NA', 'None'] else str(x).upper() for x in dat[seq_field]]
+    V = _map_categories(dat[v_field], functools.partial(getGene, action = action), memo = memo, key = ('getGene', action))
+    J = _map_categories(dat[j_field], functools.partial(getGene, action = action), memo = memo, key = ('getGene', action))
+    groups = _group_by_gene(V, J, [len(x) for x in seqs], action)
+    # groups without a complete V/J/length key fail, as do sequences with gaps or ambiguous bases
+    groups = [[i for i in g if re.search(r'[^ACGT]', seqs[i]) is None and len(seqs[i]) > 0] for k, g in groups.items() if k is not None]
+    groups = [g for g in groups if len(g) > 0]
+    if ncpu is None or int(ncpu) == 1:
+        res = [_distance_clones([seqs[i] for i in g], model, distance, norm, sym, linkage) for g in groups]
+    else:
+        res = Parallel(n_jobs = int(ncpu))(delayed(_distance_clones)([seqs[i] for i in g], model, distance, norm, sym, linkage) for g in groups)
+    # clones are numbered consecutively over the groups
+    index, clones, n = [], [], 0
+    for g, clusters in zip(groups, res):
+        for c in clusters:
+            n += 1
+            index.extend([g[i] for i in c])
+            clones.extend([str(n)] * len(c))
+    return(pd.Series(clones, index = dat.index[index], dtype = object))
+
+
+def _group_by_gene(V, J, lengths, action = 'set'):
+    """
+    Groups contigs by V gene, J gene and junction length, as `groupByGene` in changeo's `DefineClones.py`.
+
+    With action 'set', contigs of the same length whose V gene sets and J gene sets both overlap are merged into one group, along with the gene sets of the group.
+
+    Returns
+    -------
+    dictionary of {(V, J, length) : list of contig positions}, with contigs missing any of the keys under None.
+    """
+    index = {}
+    for i, key in enumerate(zip(V, J, lengths)):
+        if any([(k is None) or (k is np.nan) or (k == '') for k in key]):
+            index.setdefault(None, []).append(i)
+        elif action == 'first':
+            index.setdefault(key, []).append(i)
+        else:
+            v, j, l = set(key[0]), set(key[1]), key[2]
+            val = [i]
+            outer = index.get(l)
+            j_matches = []
+            if outer is not None:
+                for jk in outer:
+                    if not j.isdisjoint(jk):
+                        j = j.union(jk)
+                        j_matches.append(jk)
+            for jk in j_matches:
+                v_matches = []
+                for vk in outer[jk]:
+                    if not v.isdisjoint(vk):
+                        v = v.union(vk)
+                        v_matches.append(vk)
+                if v_matches:
+                    for vk in v_matches:
+                        val += outer[jk].pop(vk)
+                    if not outer[jk]:
+                        outer.pop(jk, None)
+            index.setdefault(l, {}).setdefault(tuple(sorted(j)), {})[tuple(sorted(v))] = val
+    if action == 'first':
+        return(index)
+    groups = {None:index[None]} if None in index else {}
+    for l in index:
+        if l is not None:
+            for j in index[l]:
+                for v in index[l][j]:
+                    groups[(v, j, l)] = index[l][j][v]
+    return(groups)
+
+
+def _distance_clones(seqs, model, distance, norm, sym = 'avg', linkage = 'single'):
+    """
+    Clusters the sequences of a V/J/length group into clones with changeo's distance models, as `distanceClones` in changeo's `DefineClones.py`.
+
+    Returns
+    -------
+    list of clones, each a list of positions in `seqs`.
+    """
+    from changeo.Distance import distance_models, calcDistances, formClusters
+    nmer_len = 5 if model in ['hh_s5f', 'mk_rs5nf'] else 1
+    seq_map = {}
+    for i, seq in enumerate(seqs):
+        seq = re.sub(r'[\.-]', 'N', seq)
+        if model == 'aa':
+            from Bio.Seq import translate
+            if len(seq) % 3 > 0:
+                seq = seq + 'N' * (3 - len(seq) % 3)
+            seq = translate(seq)
+        seq_map.setdefault(seq, []).append(i)
+    sequences = list(seq_map.keys())
+    if len(sequences) == 1:
+        return([seq_map[sequences[0]]])
+    dists = calcDistances(sequences, nmer_len, distance_models[model], sym = sym, norm = norm)
+    clusters = formClusters(dists, linkage, distance)
+    clone_dict = {}
+    for i, c in enumerate(clusters):
+        clone_dict.setdefault(c, []).extend(seq_map[sequences[i]])
+    return(list(clone_dict.values()))
+
+
 def clone_size(self, max_size = None, clone_key = None, key_added = None):
     """
     Quantifies size of clones
@@ -731,6 +731,69 @@ def is_categorical(array_like):
 def type_check(dataframe, key):
     return dataframe[key].dtype == str or dataframe[key].dtype == object or is_categorical(dataframe[key]) or dataframe[key].dtype == bool
 
+def _map_categories(values, func, memo = None, key = None):
+    """
+    Applies a function once per distinct value and maps the results back with categorical codes.
+
+    Parameters
+    ----------
+    values : list, Series
+        values to map. Missing values are returned as NaN.
+    func : function
+        function applied to each distinct value.
+    memo : dict, optional
+        results from previous calls keyed on (`key`, value). Updated in place so that it can be reused across calls, e.g. `Dandelion._gene_call_memo`.
+    key : hashable, optional
+        identifies `func` in the memo.
+
+    Returns
+    -------
+    list of mapped values.
+    """
+    memo = {} if memo is None else memo
+    cat = pd.Categorical(values)
+    mapped = []
+    for c in cat.categories:
+        if (key, c) not in memo:
+            memo[(key, c)] = func(c)
+        mapped.append(memo[(key, c)])
+    # code -1 (missing) picks up the trailing NaN
+    return list(np.array(mapped + [np.nan], dtype = object)[cat.codes])
+
+def _normalise_call(call, keep_alleles = False, metadata = False):
+    """
+    Collapses the alleles of a gene call to genes, e.g. 'IGHV1-2*02,IGHV1-2*04' to 'IGHV1-2', and removes repeated genes.
+    With `metadata`, calls of multiple contigs are separated by '|' and the collapsed calls are all joined by '|', as in the `.metadata` slot.
+    """
+    call = str(call)
+    if metadata:
+        calls = dict.fromkeys([re.sub('[*][0-9][0-9]', '', c) for c in call.split('|')])
+        return('|'.join(['|'.join(dict.fromkeys(c.split(','))) for c in calls]))
+    if not keep_alleles:
+        call = re.sub('[*][0-9][0-9]', '', call)
+    return(','.join(dict.fromkeys(call.split(','))))
+
+def _normalise_gene_calls(calls, keep_alleles = False, metadata = False, memo = None):
+    """
+    Normalises gene calls with `_normalise_call`, once per distinct call.
+
+    Parameters
+    ----------
+    calls : list, Series
+        gene calls.
+    keep_alleles : bool
+        Whether or not to keep the allelic calls. Default is False.
+    metadata : bool
+        Whether or not the calls are '|' separated calls from the `.metadata` slot. Default is False.
+    memo : dict, optional
+        memo of normalised calls, e.g. `Dandelion._gene_call_memo`.
+
+    Returns
+    -------
+    list of normalised calls.
+    """
+    return(_map_categories(calls, lambda c: _normalise_call(c, keep_alleles, metadata), memo = memo, key = ('normalise', keep_alleles, metadata)))
+
 def retrieve_metadata(data, query, split, collapse, combine = False, locus = 'ig', split_by_locus = False, verbose = False):
     dat_dict = defaultdict(dict)
     dict_ = defaultdict(dict)
@@ -1147,7 +1210,7 @@ def initialize_metadata(self, cols, locus_, clonekey, collapse_alleles, verbose)
             if x in self.data:
                 for c in tmp_metadata:
                     if x in c:
-                        tmp_metadata[c] = ['|'.join(['|'.join(list(set(yy.split(',')))) for yy in list(set([re.sub('[*][0-9][0-9]', '', tx) for tx in t.split('|')]))]) for t in tmp_metadata[c]]
+                        tmp_metadata[c] = _normalise_gene_calls(tmp_metadata[c], metadata = True, memo = getattr(self, '_gene_call_memo', None))
     multi = {}
     for i in tmp_metadata.index:
         try:
@@ -1297,7 +1360,7 @@ def update_metadata(self, retrieve = None, locus = None, clone_key = None, split
                 if k in vdj_gene_ret:
                     for c in ret_metadata:
                         if k in c:
-                            ret_metadata[c] = ['|'.join(['|'.join(list(set(yy.split(',')))) for yy in list(set([re.sub('[*][0-9][0-9]', '', tx) for tx in t.split('|')]))]) for t in ret_metadata[c]]
+                            ret_metadata[c] = _normalise_gene_calls(ret_metadata[c], metadata = True, memo = getattr(self, '_gene_call_memo', None))
 
         for r in ret_metadata:
             tmp_metadata[r] = pd.Series(ret_metadata[r])
@@ -1319,6 +1382,9 @@ class Dandelion:
         self.graph = graph
         self.threshold = None
         self.germline = {}
+        # normalised gene calls are a function of the call string only, so the memo is kept when the object is re-initialized
+        if not hasattr(self, '_gene_call_memo'):
+            self._gene_call_memo = {}
 
         if germline is not None:
             self.germline.update(germline)
@@ -1551,22 +1617,22 @@ class Dandelion:
         except:
             pass
 
-        try:
-            for d in self.distance:
-                dat = pd.DataFrame(self.distance[d].toarray()) # how to make this faster?
-                dat.to_hdf(filename, "distance/"+d, complib = comp, complevel = compression_level, **kwargs)
-        except:
-            pass
-
         with h5py.File(filename,  "a") as hf:
-            # try:
-            #     for d in self.distance:
-            #         hf.create_dataset('distance/'+d+'/data', data=self.distance[d].data, compression = compression, compression_opts = compression_level)
-            #         hf.create_dataset('distance/'+d+'/indptr', data=self.distance[d].indptr, compression = compression, compression_opts = compression_level)
-            #         hf.create_dataset('distance/'+d+'/indices', data=self.distance[d].indices, compression = compression, compression_opts = compression_level)
-            #         hf['distance/'+d].attrs['shape'] = self.distance[d].shape
-            # except:
-            #     pass
+            # the sparse arrays are saved as they are, as explicit zeros (identical sequences) would be lost in a dense copy
+            h5comp = None if comp is None else 'gzip'
+            h5level = None if comp is None else min(compression_level, 9)
+            try:
+                for d in self.distance:
+                    mat = scipy.sparse.csr_matrix(self.distance[d])
+                    hf.create_dataset('distance/'+d+'/data', data=mat.data, compression = h5comp, compression_opts = h5level)
+                    hf.create_dataset('distance/'+d+'/indptr', data=mat.indptr, compression = h5comp, compression_opts = h5level)
+                    hf.create_dataset('distance/'+d+'/indices', data=mat.indices, compression = h5comp, compression_opts = h5level)
+                    hf['distance/'+d].attrs['shape'] = mat.shape
+                    cell_ids = getattr(self.distance[d], 'cell_ids', None)
+                    if cell_ids is not None:
+                        hf.create_dataset('distance/'+d+'/cell_ids', data=np.array([str(c).encode('utf-8') for c in cell_ids]), compression = h5comp, compression_opts = h5level)
+            except:
+                pass
 
             try:
                 layout_counter = 0
@@ -1692,10 +1758,17 @@ def read_h5(filename='dandelion_data.h5'):
         distance = Tree()
         try:
             for d in hf['distance'].keys():
-                d_ = pd.read_hdf(filename, 'distance/'+d)
-                distance[d] = scipy.sparse.csr_matrix(d_.values)
-                # d_ = hf['distance'][d]
-                # distance[d] = scipy.sparse.csr_matrix((d_['data'][:],d_['indices'][:], d_['indptr'][:]), d_.attrs['shape'])
+                d_ = hf['distance'][d]
+                if 'indptr' in d_:
+                    distance[d] = scipy.sparse.csr_matrix((d_['data'][:], d_['indices'][:], d_['indptr'][:]), tuple(d_.attrs['shape']))
+                    if 'cell_ids' in d_:
+                        distance[d].cell_ids = np.array([c.decode('utf-8') for c in d_['cell_ids'][:]], dtype = object)
+                else:
+                    # files written by earlier versions hold dense data frames
+                    df_ = pd.read_hdf(filename, 'distance/'+d)
+                    distance[d] = scipy.sparse.csr_matrix(df_.values)
+                    if not isinstance(df_.index, pd.RangeIndex):
+                        distance[d].cell_ids = np.asarray(df_.index)
         except:
             pass
 
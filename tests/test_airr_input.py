@@ -2,11 +2,27 @@
 # basic requirements for test data
 import sys
 import os
+import math
+import tracemalloc
 from io import StringIO
 import requests
+import numpy as np
 import pandas as pd
 import scanpy as sc
 import dandelion as ddl
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from dandelion.tools._distance import _encode_junctions, _blocked_pairs, _nearest_rows, _neighbour_pairs, _pigeonhole_pairs
+from dandelion.tools._tools import _group_junctions
+
+
+def _same_partition(x, y):
+    pairs = pd.DataFrame({"x": x, "y": y}).dropna()
+    return (pairs.groupby("x")["y"].nunique() == 1).all() and (pairs.groupby("y")["x"].nunique() == 1).all()
+
+
+def _edge_set(edges):
+    return set(zip(edges["source"], edges["target"], edges["weight"]))
 
 
 def test_setup():
@@ -53,6 +69,157 @@ def test_find_clones():
     print(test)
 
 
+def test_find_clones_parallel():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, key_added="clone_id_parallel", ncpu=2)
+    assert test.data["clone_id_parallel"].equals(test.data["clone_id"])
+    print(test)
+
+
+def test_find_clones_max_memory():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, key_added="clone_id_blocked", max_memory="1MB")
+    assert test.data["clone_id_blocked"].equals(test.data["clone_id"])
+    print(test)
+
+
+def _junction_families(n_families=200, n_members=10, length=15, n_mutations=3, seed=0):
+    # families of junctions a few mutations apart, so that there are pairs on both sides of the threshold
+    rng = np.random.default_rng(seed)
+    aa = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    junctions = []
+    for family in rng.integers(0, 20, size=(n_families, length)):
+        for _ in range(n_members):
+            junction = family.copy()
+            junction[rng.integers(0, length, size=n_mutations)] = rng.integers(0, 20, size=n_mutations)
+            junctions.append("".join(aa[junction]))
+    return junctions
+
+
+def test_find_clones_memory_bound():
+    X = _encode_junctions(_junction_families(length=30))
+    old = _encode_junctions(_junction_families(length=30, seed=1))
+    for max_memory in [2**20, 2**22]:
+        # only the sub-threshold pairs that are returned may come on top of the budget
+        tracemalloc.start()
+        pairs = _blocked_pairs(X, 3, max_memory=max_memory)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert len(pairs[0]) > 0
+        assert peak <= max_memory + 2 * sum([x.nbytes for x in pairs])
+        tracemalloc.start()
+        nearest = _nearest_rows(X, old, max_memory=max_memory)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert peak <= max_memory + sum([x.nbytes for x in nearest])
+
+
+def test_find_clones_pigeonhole():
+    X = _encode_junctions(_junction_families())
+    for max_distance in [1, 2, 3]:
+        pairs = _pigeonhole_pairs(X, max_distance, max_memory=2**16)
+        assert pairs is not None
+        assert set(zip(*pairs)) == set(zip(*_blocked_pairs(X, max_distance)))
+
+
+def test_find_clones_duplicates():
+    test = ddl.read_h5("tests/test.h5")
+    heavy = test.data[test.data["locus"] == "IGH"]
+    # contigs with identical genes and junctions are in the same heavy chain clone, before it is split by light chain
+    heavy_clone = heavy["clone_id"].str.split("_").str[:3].str.join("_")
+    assert (heavy_clone.groupby([heavy["v_call"], heavy["j_call"], heavy["junction_aa"]]).nunique() == 1).all()
+
+
+def test_find_clones_single_linkage():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, key_added="clone_id_single", linkage="single")
+    heavy = test.data[test.data["locus"] == "IGH"]
+    single = heavy["clone_id_single"].str.split("_").str[:3].str.join("_")
+    # clones are the connected components of the pairs within the threshold of each V/J/length partition
+    for _, partition in heavy.groupby(single.str.split("_").str[:2].str.join("_")):
+        seqs = sorted(partition["junction_aa"].unique())
+        source, target, _ = _neighbour_pairs(_encode_junctions(seqs), math.floor(len(seqs[0]) * (1 - 0.85)))
+        clones = single[partition.index].groupby(partition["junction_aa"]).first()[seqs].values
+        assert (clones[source] == clones[target]).all()
+        n_components = connected_components(coo_matrix((np.ones(len(source)), (source, target)), shape=(len(seqs), len(seqs))))[0]
+        assert len(set(clones)) == n_components
+    # A-B and B-C are within the threshold while A-C is not, and the chain still forms one clone
+    chain = ["AAAAAAAAAA", "CAAAAAAAAA", "CCAAAAAAAA"]
+    assert len(_neighbour_pairs(_encode_junctions(chain), 1)[0]) == 2
+    assert len(set(_group_junctions(chain, 10, 0.85, linkage="single"))) == 1
+
+
+def test_find_clones_sweep():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, identity=[0.8, 0.85, 0.9, 0.95])
+    # each column of the sweep is the single linkage clustering at that identity
+    for identity in [0.8, 0.85, 0.9, 0.95]:
+        ddl.tl.find_clones(test, identity=identity, key_added="clone_id_single", linkage="single")
+        assert test.data["clone_id_" + str(identity)].equals(test.data["clone_id_single"])
+    print(test)
+
+
+def test_find_clones_paired():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, key_added="clone_id_paired", paired=True)
+    clones = test.data["clone_id_paired"].dropna()
+    # light chains are clustered together with the heavy chains, so clones are not split by light chain afterwards
+    assert (clones.str.split("_").str.len() == 3).all()
+    assert (clones.groupby(test.data["cell_id"]).nunique() == 1).all()
+    print(test)
+
+
+def test_find_clones_indel():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, key_added="clone_id_single", linkage="single")
+    ddl.tl.find_clones(test, key_added="clone_id_indel", linkage="single", indel=1)
+    heavy = test.data[test.data["locus"] == "IGH"]
+    # comparing junctions across lengths can only merge the heavy chain clones found within each length
+    single = heavy["clone_id_single"].str.split("_").str[:3].str.join("_")
+    indel = heavy["clone_id_indel"].str.split("_").str[:3].str.join("_")
+    assert (indel.groupby(single).nunique() == 1).all()
+    print(test)
+
+
+def test_find_clones_hash_ids():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, key_added="clone_id_hash", hash_ids=True)
+    assert _same_partition(test.data["clone_id_hash"], test.data["clone_id"])
+    # a shard holding whole V/J groups gets the same ids for them as the full run
+    heavy = test.data[test.data["locus"] == "IGH"]
+    odd = heavy["clone_id"].str.split("_").str[0].astype(int) % 2 == 1
+    shard = ddl.Dandelion(test.data[test.data["cell_id"].isin(heavy.loc[odd, "cell_id"])])
+    ddl.tl.find_clones(shard, key_added="clone_id_hash", hash_ids=True)
+    ids = heavy.index[odd]
+    assert shard.data.loc[ids, "clone_id_hash"].equals(test.data.loc[ids, "clone_id_hash"])
+    print(test)
+
+
+def test_find_clones_incremental():
+    test = ddl.read_h5("tests/test.h5")
+    new_cells = test.data["cell_id"].unique()[:100]
+    existing = test.data.index[~test.data["cell_id"].isin(new_cells)]
+    clones = test.data.loc[existing, "clone_id"].copy()
+    test.data.loc[test.data["cell_id"].isin(new_cells), "clone_id"] = None
+    ddl.tl.find_clones(test, incremental=True)
+    assert test.data.loc[existing, "clone_id"].equals(clones)
+    print(test)
+
+
+def test_clone_index():
+    test = ddl.read_h5("tests/test.h5")
+    new_cells = test.data["cell_id"].unique()[:100]
+    test.data.loc[test.data["cell_id"].isin(new_cells), "clone_id"] = None
+    idx = ddl.tl.build_clone_index(test)
+    idx.write("tests/test.cloneidx")
+    idx = ddl.tl.read_clone_index("tests/test.cloneidx")
+    ddl.tl.find_clones(test, incremental=True, clone_index=idx)
+    rebuilt = ddl.tl.build_clone_index(test)
+    assert idx.n_contigs == rebuilt.n_contigs
+    assert idx.params["checksum"] == rebuilt.params["checksum"]
+    print(idx)
+
+
 def test_generate_network():
     test = ddl.read_h5("tests/test.h5")
     ddl.tl.generate_network(test, key="sequence_alignment")
@@ -60,6 +227,68 @@ def test_generate_network():
     print(test)
 
 
+def test_generate_network_stored_distance():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, store_distance=True)
+    ddl.tl.generate_network(test, distance_key="junction")
+    print(test)
+
+
+def test_stored_distance_h5():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.find_clones(test, store_distance=True)
+    ddl.tl.generate_network(test, distance_key="junction")
+    test.write_h5("tests/test_distance.h5", compression="bzip2")
+    # identical junctions are stored as explicit zeros, which have to survive the round trip
+    saved = ddl.read_h5("tests/test_distance.h5")
+    assert saved.distance["junction"].nnz == test.distance["junction"].nnz
+    assert (saved.distance["junction"].cell_ids == test.distance["junction"].cell_ids).all()
+    ddl.tl.generate_network(saved, distance_key="junction")
+    assert _edge_set(saved.edges) == _edge_set(test.edges)
+
+
+def test_generate_network_parallel():
+    serial = ddl.read_h5("tests/test.h5")
+    parallel = ddl.read_h5("tests/test.h5")
+    ddl.tl.generate_network(serial, key="sequence_alignment", ncpu=1)
+    ddl.tl.generate_network(parallel, key="sequence_alignment", ncpu=2)
+    for x in serial.distance:
+        assert (parallel.distance[x] != serial.distance[x]).nnz == 0
+    assert _edge_set(parallel.edges) == _edge_set(serial.edges)
+    assert parallel.edges["weight"].sum() == serial.edges["weight"].sum()
+    print(parallel)
+
+
+def test_generate_network_max_distance():
+    test = ddl.read_h5("tests/test.h5")
+    ddl.tl.generate_network(test, key="sequence_alignment")
+    # a cap that no pair within a clone exceeds gives the exact network
+    threshold = int(max([test.distance[x].max() for x in test.distance]))
+    capped = ddl.read_h5("tests/test.h5")
+    ddl.tl.generate_network(capped, key="sequence_alignment", max_distance=threshold)
+    assert _edge_set(capped.edges) == _edge_set(test.edges)
+    assert capped.edges["weight"].sum() == test.edges["weight"].sum()
+    # pairs further apart than a lower cap are stored as max_distance + 1, identical sequences are still linked
+    ddl.tl.generate_network(capped, key="sequence_alignment", max_distance=5)
+    for x in test.distance:
+        assert (capped.distance[x] != test.distance[x].minimum(6)).nnz == 0
+    assert _edge_set(capped.edges[capped.edges["weight"] == 0]) == _edge_set(test.edges[test.edges["weight"] == 0])
+    print(capped)
+
+
+def test_generate_network_approximate():
+    exact = ddl.read_h5("tests/test.h5")
+    approximate = ddl.read_h5("tests/test.h5")
+    ddl.tl.generate_network(exact, key="sequence_alignment", approximate=False)
+    ddl.tl.generate_network(approximate, key="sequence_alignment", approximate=True)
+    # only the layout is approximated
+    assert _edge_set(approximate.edges) == _edge_set(exact.edges)
+    assert set(approximate.layout[0]) == set(exact.layout[0])
+    for layout in approximate.layout:
+        assert np.isfinite(np.array(list(layout.values()))).all()
+    print(approximate)
+
+
 def test_downsampling():
     test = ddl.read_h5("tests/test.h5")
     test_downsample = ddl.tl.generate_network(
@@ -99,6 +328,23 @@ def test_define_clones():
     print(test)
 
 
+def test_define_clones_fixture():
+    test = ddl.Dandelion(pd.read_csv("tests/define_clones_input.tsv", sep="\t"))
+    ddl.tl.define_clones(test, dist=0.1, ncpu=1)
+    # clone ids from the DefineClones.py based implementation, with the same arguments
+    expected = pd.read_csv("tests/define_clones_clone.tsv", sep="\t", index_col="sequence_id")["clone_id"]
+    heavy = test.data.index[test.data["locus"] == "IGH"]
+    # the heavy chain clones before they are split by light chain
+    assert _same_partition(test.data.loc[heavy, "clone_id"].str.split("_").str[0], expected[heavy].str.split("_").str[0])
+    # and after the split, where cells sharing a light chain group are linked
+    assert _same_partition(test.data.loc[heavy, "clone_id"], expected[heavy])
+    # light chains are relinked to the clone of their cell's heavy chain, or flagged as not linked
+    light = test.data.index[test.data["locus"] != "IGH"]
+    assert test.data.loc[light, "clone_id"].str.endswith("_notlinked").equals(expected[light].str.endswith("_notlinked"))
+    assert _same_partition(test.data["clone_id"], expected[test.data.index])
+    print(test)
+
+
 def test_quantify_mutations():
     test = ddl.read_h5("tests/test.h5")
     ddl.pp.quantify_mutations(test, germline_column="germline_alignment")
@@ -110,9 +356,27 @@ if __name__ == "__main__":
     test_filter()
     test_update_metadata()
     test_find_clones()
+    test_find_clones_parallel()
+    test_find_clones_max_memory()
+    test_find_clones_memory_bound()
+    test_find_clones_pigeonhole()
+    test_find_clones_duplicates()
+    test_find_clones_single_linkage()
+    test_find_clones_sweep()
+    test_find_clones_paired()
+    test_find_clones_indel()
+    test_find_clones_hash_ids()
+    test_find_clones_incremental()
+    test_clone_index()
     test_generate_network()
+    test_generate_network_stored_distance()
+    test_stored_distance_h5()
+    test_generate_network_parallel()
+    test_generate_network_max_distance()
+    test_generate_network_approximate()
     test_downsampling()
     test_transfer()
     test_create_germlines()
     test_define_clones()
+    test_define_clones_fixture()
     test_quantify_mutations()